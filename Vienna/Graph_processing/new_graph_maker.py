@@ -1,7 +1,5 @@
 import geopandas as gpd
-from shapely.geometry import LineString
 import shapely
-import momepy
 import osmnx as ox
 import networkx as nx
 import numpy as np
@@ -15,36 +13,67 @@ import numpy as np
 # # Get the biggest node index
 # new_node_idx = max(nodes.index.to_list()) + 1
 
-graph = gpd.read_file('Vienna/exploded.gpkg')
-graph['length'] = graph.geometry.length
-# Function to round a coordinate to a specified number of decimal places
-def round_coordinates(row, num_decimal_places):
-    return shapely.transform(row, lambda x: np.round(x,decimals=2))
-     
- 
-# Specify the number of decimal places you want to round to
-num_decimal_places = 2
- 
-# Apply the rounding function to X and Y coordinates in the geometry
-graph['geometry'] = graph['geometry'].apply(lambda row: round_coordinates(row, num_decimal_places))
-
-new_graph = momepy.gdf_to_nx(graph, length = 'length', directed = True)
-
-nodes, edges = momepy.nx_to_gdf(new_graph, nodeID='osmid')
-
-edges['u'] = edges['node_start']
-edges['v'] = edges['node_end']
-edges['key'] = 0
-edges.set_index(['u', 'v', 'key'], inplace = True)
-nodes.set_index('osmid', inplace = True)
-edges.to_crs(epsg=4326, inplace = True)
-nodes.to_crs(epsg=4326, inplace = True)
-nodes['x'] = nodes.geometry.x
-nodes['y'] = nodes.geometry.y
-G_new = ox.graph_from_gdfs(nodes, edges)
-
-print(nx.is_strongly_connected(G_new))
-
-city = 'Vienna'
-ox.save_graphml(G_new, city + '/streets_new_new.graphml')
-ox.save_graph_geopackage(G_new, city + '/streets_new_new.gpkg', directed = True)
\ No newline at end of file
+def build_graph(graph: gpd.GeoDataFrame, num_decimal_places: int = 2) -> nx.MultiDiGraph:
+    """Builds the directed street graph from a GeoDataFrame of exploded street lines
+    in a metric CRS. Every line is an edge from its first to its last point. The
+    coordinates are rounded such that the endpoints of lines that meet snap to the same
+    node, and the nodes are the unique endpoint coordinates. All the geometry work is
+    done on whole arrays at once.
+
+    Args:
+        graph (gpd.GeoDataFrame): The street lines.
+        num_decimal_places (int): Decimals of the coordinates in the CRS of the lines.
+
+    Returns:
+        nx.MultiDiGraph: The graph in EPSG:4326, ready for osmnx.
+    """
+    # Round all coordinates in one call
+    geometry = shapely.transform(graph.geometry.values, lambda x: np.round(x, decimals = num_decimal_places))
+    length = shapely.length(geometry)
+    # Endpoints of every line, the nodes are the unique ones
+    starts = shapely.get_coordinates(shapely.get_point(geometry, 0))
+    ends = shapely.get_coordinates(shapely.get_point(geometry, -1))
+    node_coords, inverse = np.unique(np.vstack([starts, ends]), axis = 0, return_inverse = True)
+    inverse = inverse.ravel()
+    u, v = inverse[:len(geometry)], inverse[len(geometry):]
+    # Parallel edges between the same nodes get increasing keys by length, such that key 0,
+    # which the routing and scenario code use, is the shortest one
+    order = np.lexsort((length, v, u))
+    uv = np.column_stack([u[order], v[order]])
+    new_group = np.concatenate([[True], np.any(uv[1:] != uv[:-1], axis = 1)])
+    group_start = np.maximum.accumulate(np.where(new_group, np.arange(len(uv)), 0))
+    key = np.empty(len(uv), dtype = np.int64)
+    key[order] = np.arange(len(uv)) - group_start
+
+    # To lat/lon
+    node_lonlat = shapely.get_coordinates(
+        gpd.GeoSeries(shapely.points(node_coords), crs = graph.crs).to_crs(epsg = 4326).values)
+    edge_geometry = gpd.GeoSeries(geometry, crs = graph.crs).to_crs(epsg = 4326).values
+
+    # Build the graph straight from the arrays
+    G = nx.MultiDiGraph(crs = 'epsg:4326')
+    G.add_nodes_from((i, {'x': x, 'y': y}) for i, (x, y) in enumerate(node_lonlat.tolist()))
+    columns = graph.drop(columns = [graph.geometry.name, 'length'], errors = 'ignore')
+    # One dict per line, also when there are no other columns
+    attributes = columns.to_dict('records') if len(columns.columns) else [{} for _ in range(len(graph))]
+    for i, data in enumerate(attributes):
+        data['length'] = float(length[i])
+        data['geometry'] = edge_geometry[i]
+        data['node_start'] = int(u[i])
+        data['node_end'] = int(v[i])
+    G.add_edges_from(zip(u.tolist(), v.tolist(), key.tolist(), attributes, strict = True))
+    return G
+
+if __name__ == '__main__':
+    graph = gpd.read_file('Vienna/exploded.gpkg')
+
+    # Specify the number of decimal places you want to round to
+    num_decimal_places = 2
+
+    G_new = build_graph(graph, num_decimal_places)
+
+    print(nx.is_strongly_connected(G_new))
+
+    city = 'Vienna'
+    ox.save_graphml(G_new, city + '/streets_new_new.graphml')
+    ox.save_graph_geopackage(G_new, city + '/streets_new_new.gpkg', directed = True)
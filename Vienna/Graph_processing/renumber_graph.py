@@ -0,0 +1,113 @@
+import osmnx as ox
+import networkx as nx
+import numpy as np
+import pickle
+
+# Renumbers the nodes of streets.graphml along a space filling curve, such that nodes
+# that are close in the city also get close ids. The routers build their arrays in
+# node order, so this makes the adjacency and coordinate lookups cache friendly.
+# The node ids change, so run this before making the spawn points, routes and
+# intentions, and rename the output to streets.graphml.
+
+def hilbert_index(x: np.ndarray, y: np.ndarray, order: int) -> np.ndarray:
+    """Gives the position along the Hilbert curve of integer grid coordinates.
+
+    Args:
+        x (np.ndarray): Integer x coordinates, from 0 to 2**order - 1.
+        y (np.ndarray): Integer y coordinates, from 0 to 2**order - 1.
+        order (int): Number of bits of the grid.
+    """
+    n = 1 << order
+    x = x.astype(np.int64).copy()
+    y = y.astype(np.int64).copy()
+    d = np.zeros(len(x), dtype = np.int64)
+    s = n >> 1
+    while s > 0:
+        rx = ((x & s) > 0).astype(np.int64)
+        ry = ((y & s) > 0).astype(np.int64)
+        d += s * s * ((3 * rx) ^ ry)
+        # Rotate the quadrant
+        flip = (ry == 0) & (rx == 1)
+        x = np.where(flip, n - 1 - x, x)
+        y = np.where(flip, n - 1 - y, y)
+        swap = ry == 0
+        x, y = np.where(swap, y, x), np.where(swap, x, y)
+        s >>= 1
+    return d
+
+def morton_index(x: np.ndarray, y: np.ndarray, order: int) -> np.ndarray:
+    """Gives the position along the Morton (Z-order) curve of integer grid coordinates,
+    by interleaving the bits of x and y."""
+    x = x.astype(np.int64)
+    y = y.astype(np.int64)
+    d = np.zeros(len(x), dtype = np.int64)
+    for bit in range(order):
+        d |= ((x >> bit) & 1) << (2 * bit)
+        d |= ((y >> bit) & 1) << (2 * bit + 1)
+    return d
+
+def renumber_graph(G: nx.MultiDiGraph, curve: str = 'hilbert', order: int = 16) -> tuple:
+    """Makes a copy of the graph with the nodes numbered 0 to n-1 along a space filling
+    curve. The nodes are inserted in the new order and the edges sorted by their new
+    (u, v, key), so the adjacency is in the same order as well.
+
+    Args:
+        G (nx.MultiDiGraph): The street graph.
+        curve (str): 'hilbert' or 'morton'.
+        order (int): Number of bits per coordinate of the grid that the nodes are snapped to.
+
+    Returns:
+        tuple: The renumbered graph, and the dicts new id -> old id and old id -> new id.
+    """
+    old_ids = np.array(list(G.nodes()))
+    x = np.array([G.nodes[node]['x'] for node in old_ids], dtype = float)
+    y = np.array([G.nodes[node]['y'] for node in old_ids], dtype = float)
+    # Snap the coordinates to a grid of 2**order cells, with the same scale in x and y
+    # such that the curve is not stretched.
+    scale = ((1 << order) - 1) / max(np.ptp(x), np.ptp(y), 1e-12)
+    grid_x = np.floor((x - x.min()) * scale)
+    grid_y = np.floor((y - y.min()) * scale)
+    if curve == 'hilbert':
+        index = hilbert_index(grid_x, grid_y, order)
+    elif curve == 'morton':
+        index = morton_index(grid_x, grid_y, order)
+    else:
+        raise ValueError(f'Curve {curve} is not implemented.')
+    # Stable sort, nodes in the same grid cell keep their old order
+    new_order = np.argsort(index, kind = 'stable')
+    id2old = {new_id: old_ids[i].item() for new_id, i in enumerate(new_order)}
+    old2id = {old_id: new_id for new_id, old_id in id2old.items()}
+
+    G_new = nx.MultiDiGraph()
+    G_new.graph.update(G.graph)
+    G_new.add_nodes_from((new_id, G.nodes[old_id]) for new_id, old_id in id2old.items())
+    edges = sorted((old2id[u], old2id[v], key, data) for u, v, key, data in G.edges(keys = True, data = True))
+    for u, v, key, data in edges:
+        data = dict(data)
+        # The momepy node references of the edges follow the new numbering
+        if 'node_start' in data:
+            data['node_start'] = str(u)
+        if 'node_end' in data:
+            data['node_end'] = str(v)
+        G_new.add_edge(u, v, key = key, **data)
+    return G_new, id2old, old2id
+
+def edge_id_span(G: nx.MultiDiGraph) -> float:
+    """Mean difference between the ids of the two nodes of an edge, lower is more local."""
+    return float(np.mean([abs(u - v) for u, v in G.edges()]))
+
+if __name__ == '__main__':
+    city = '..'
+    G = ox.load_graphml(city + '/streets.graphml')
+    G_new, id2old, old2id = renumber_graph(G, 'hilbert')
+    print(f'Mean node id span of the edges: {edge_id_span(G):.1f} -> {edge_id_span(G_new):.1f}')
+
+    if nx.is_strongly_connected(G_new):
+        print('Graph is fully connected.')
+    # Save the renumbered graph, and the mapping tables next to it. The new ids are
+    # 0..n-1 without gaps, and graphml is what all the makers load.
+    ox.save_graphml(G_new, city + '/streets_renumbered.graphml')
+    with open(city + '/renumbered_id2old.pickle', 'wb') as f:
+        pickle.dump(id2old, f)
+    with open(city + '/renumbered_old2id.pickle', 'wb') as f:
+        pickle.dump(old2id, f)
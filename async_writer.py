@@ -0,0 +1,170 @@
+import gzip
+import io
+import os
+import queue
+import socket
+import threading
+from multiprocessing import util
+
+# File name suffix of each compression
+COMPRESSION_SUFFIX = {None: '', 'gzip': '.gz', 'zstd': '.zst'}
+
+def open_compressed(path: str, mode: str = 'rt', compression: str = None):
+    """Opens a text file with the given compression, or guesses it from the suffix.
+
+    Args:
+        path (str): Path of the file.
+        mode (str): 'rt' or 'wt'.
+        compression (str): None, 'gzip' or 'zstd'. Guessed from the suffix if reading.
+    """
+    if compression is None and 'r' in mode:
+        compression = {'.gz': 'gzip', '.zst': 'zstd'}.get(os.path.splitext(path)[1])
+    if compression == 'gzip':
+        # Low compression level, the scenario text is very repetitive anyway
+        return gzip.open(path, mode, compresslevel = 3) if 'w' in mode else gzip.open(path, mode)
+    elif compression == 'zstd':
+        try:
+            import zstandard
+        except ImportError:
+            raise ImportError('zstd compression needs the zstandard package.')
+        if 'w' in mode:
+            raw = zstandard.ZstdCompressor(level = 3).stream_writer(open(path, 'wb'))
+        else:
+            raw = zstandard.ZstdDecompressor().stream_reader(open(path, 'rb'))
+        return io.TextIOWrapper(raw, encoding = 'utf-8')
+    elif compression is None:
+        return open(path, mode)
+    raise ValueError(f'Compression {compression} is not implemented.')
+
+class BackgroundFile:
+    def __init__(self, writer, file_id: int, buffer_size: int) -> None:
+        """File handle of a BackgroundWriter. Text is buffered and handed to the writer
+        thread in chunks."""
+        self.writer = writer
+        self.file_id = file_id
+        self.buffer_size = buffer_size
+        self.buffer = []
+        self.buffered = 0
+        return
+
+    def write(self, text: str) -> None:
+        self.buffer.append(text)
+        self.buffered += len(text)
+        if self.buffered >= self.buffer_size:
+            self.writer.queue.put(('data', self.file_id, ''.join(self.buffer)))
+            self.buffer = []
+            self.buffered = 0
+        return
+
+    def close(self) -> None:
+        if self.buffer:
+            self.writer.queue.put(('data', self.file_id, ''.join(self.buffer)))
+            self.buffer = []
+        self.writer.queue.put(('close', self.file_id, None))
+        return
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+class BackgroundWriter:
+    def __init__(self, max_queue: int = 256, buffer_size: int = 1 << 20) -> None:
+        """Writes files on a background thread, such that the computation does not wait
+        for the disk. Chunks of text go through a bounded queue, and every file is first
+        written under a hidden temporary name of this process in the same folder and only
+        renamed to its final name once it is complete.
+
+        Args:
+            max_queue (int): Maximum number of chunks waiting to be written.
+            buffer_size (int): Number of characters buffered per file before a chunk is queued.
+        """
+        self.queue = queue.Queue(max_queue)
+        self.buffer_size = buffer_size
+        self.next_id = 0
+        self.errors = []
+        self.thread = threading.Thread(target = self.run, daemon = True)
+        self.thread.start()
+        return
+
+    def open(self, path: str, compression: str = None) -> BackgroundFile:
+        """Opens a file to write in the background.
+
+        Args:
+            path (str): Final path of the file. The suffix of the compression is appended.
+            compression (str): None, 'gzip' or 'zstd'.
+        """
+        file_id = self.next_id
+        self.next_id += 1
+        self.queue.put(('open', file_id, (path + COMPRESSION_SUFFIX[compression], compression)))
+        return BackgroundFile(self, file_id, self.buffer_size)
+
+    def run(self) -> None:
+        # Open files, file id -> (file object, temporary path, final path)
+        files = dict()
+        while True:
+            command, file_id, data = self.queue.get()
+            try:
+                if command == 'open':
+                    path, compression = data
+                    folder, filename = os.path.split(path)
+                    # Unique per process, such that jobs on several machines never share one
+                    tmp_path = os.path.join(folder, f'.{filename}.{socket.gethostname()}.{os.getpid()}.tmp')
+                    files[file_id] = (open_compressed(tmp_path, 'wt', compression), tmp_path, path)
+                elif command == 'data':
+                    if file_id in files:
+                        files[file_id][0].write(data)
+                elif command == 'close':
+                    if file_id in files:
+                        f, tmp_path, path = files.pop(file_id)
+                        f.close()
+                        os.replace(tmp_path, path)
+                elif command == 'stop':
+                    break
+            except Exception as e:
+                # Drop the file, and report the error at the next flush
+                if file_id in files:
+                    f, tmp_path, _ = files.pop(file_id)
+                    f.close()
+                    os.remove(tmp_path)
+                self.errors.append(e)
+            finally:
+                self.queue.task_done()
+        return
+
+    def check(self) -> None:
+        """Raises the first error that happened while writing so far, without waiting."""
+        if self.errors:
+            errors, self.errors = self.errors, []
+            raise errors[0]
+        return
+
+    def flush(self) -> None:
+        """Waits until everything that was queued is on disk, and raises the first error
+        that happened while writing. Pool workers should flush once before the pool is
+        closed, as errors that are only found when the process exits cannot reach the caller."""
+        self.queue.join()
+        self.check()
+        return
+
+    def close(self) -> None:
+        self.flush()
+        self.queue.put(('stop', None, None))
+        self.thread.join()
+        return
+
+# The writer of this process, threads do not survive a fork so it is made per process
+process_writer = None
+process_writer_pid = None
+
+def get_writer() -> BackgroundWriter:
+    """Gives the background writer of this process. It is closed, and so everything is
+    written, when the process exits. Pools should be closed and joined, not terminated,
+    for this to happen in their workers."""
+    global process_writer, process_writer_pid
+    if process_writer is None or process_writer_pid != os.getpid():
+        process_writer = BackgroundWriter()
+        process_writer_pid = os.getpid()
+        util.Finalize(process_writer, process_writer.close, exitpriority = 10)
+    return process_writer
@@ -1,47 +1,57 @@
 # Simple script to create a batch file
 import os
-filename5 = 'Vienna/M2.2/batch5.scn'
-filename6 = 'Vienna/M2.2/batch6.scn'
-filename7 = 'Vienna/M2.2/batch7.scn'
-    
-all_scens = [x for x in os.listdir('Vienna/M2.2') if ('batch' not in x) and ('DS' not in x)]
-to_include = all_scens
-
-# Split into two
-len_batch = int(len(all_scens)/4)
-batch5_scens = to_include[:len_batch]
-batch6_scens = to_include[len_batch:len_batch*2]
-#batch7_scens = to_include[len_batch*2:]
-batch5_scens = to_include[len_batch*2:len_batch*3]
-batch6_scens = to_include[len_batch*3:]
-
-
-with open(filename5, 'w') as f:
-    for scenario in batch5_scens:
-        scen_name = scenario.replace('.scn','')
-        
-        to_write = f'00:00:00.00>SCEN {scen_name}\n' + \
-                    f'00:00:00.00>PCALL M2.2/{scenario}\n' + \
-                    '00:00:00.00>FF\n\n'
-                    
-        f.write(to_write)
-        
-with open(filename6, 'w') as f:
-    for scenario in batch6_scens:
-        scen_name = scenario.replace('.scn','')
-        
-        to_write = f'00:00:00.00>SCEN {scen_name}\n' + \
-                    f'00:00:00.00>PCALL M2.2/{scenario}\n' + \
-                    '00:00:00.00>FF\n\n'
-                    
-        f.write(to_write)
-        
-# with open(filename7, 'w') as f:
-#     for scenario in batch7_scens:
-#         scen_name = scenario.replace('.scn','')
-        
-#         to_write = f'00:00:00.00>SCEN {scen_name}\n' + \
-#                     f'00:00:00.00>PCALL M2.2/{scenario}\n' + \
-#                     '00:00:00.00>FF\n\n'
-                    
-#         f.write(to_write)
+
+from scenario_maker import read_manifest
+
+def make_batch_file(filename: str, scenarios: list) -> None:
+    """Writes a batch file that runs the given experiment scenarios one after the other."""
+    with open(filename, 'w') as f:
+        for scenario in scenarios:
+            scen_name = scenario.replace('.scn','')
+
+            to_write = f'00:00:00.00>SCEN {scen_name}\n' + \
+                        f'00:00:00.00>PCALL M2.2/{scenario}\n' + \
+                        '00:00:00.00>FF\n\n'
+
+            f.write(to_write)
+    return
+
+def make_batches(scen_path: str = 'Vienna/M2.2', num_splits: int = 4, batch_numbers: dict = None) -> None:
+    """Splits the experiment scenarios in equal parts and makes a batch file per part.
+
+    Args:
+        scen_path (str): Folder with the experiment scenarios, the batches are saved there too.
+        num_splits (int): Number of parts to split the scenarios in. The last one gets the rest.
+        batch_numbers (dict): Which parts to write, as {part index: batch number}. All parts,
+        numbered from 1, if None.
+    """
+    # The experiments in the order of the manifest, or else whatever is in the folder
+    manifest = read_manifest(scen_path)
+    if manifest is not None:
+        # With shards, the manifest can list files that other shards did not write yet
+        all_scens = [row['filename'] for row in manifest if os.path.exists(os.path.join(scen_path, row['filename']))]
+        if len(all_scens) < len(manifest):
+            print(f'{len(manifest) - len(all_scens)} experiments of the manifest are not made yet, they are left out.')
+    else:
+        all_scens = [x for x in os.listdir(scen_path) if ('batch' not in x) and ('DS' not in x)]
+    to_include = all_scens
+
+    if batch_numbers is None:
+        batch_numbers = {i: i+1 for i in range(num_splits)}
+
+    len_batch = int(len(all_scens)/num_splits)
+    for split, batch_number in batch_numbers.items():
+        if split == num_splits - 1:
+            batch_scens = to_include[len_batch*split:]
+        else:
+            batch_scens = to_include[len_batch*split:len_batch*(split+1)]
+        make_batch_file(f'{scen_path}/batch{batch_number}.scn', batch_scens)
+    return
+
+def main():
+    # Third and fourth quarter as batches 5 and 6
+    make_batches(num_splits = 4, batch_numbers = {2: 5, 3: 6})
+    return
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,231 @@
+"""Command line entry point for the whole scenario generation pipeline.
+
+Every stage imports its own maker, and with it the heavy dependencies, only when it
+is run. This way the light stages like experiments and batches start right away.
+
+Usage:
+    python cli.py origins
+    python cli.py routes --num-cpu 8
+    python cli.py intentions --num-cpu 4
+    python cli.py intentions --update --timespan 120
+    python cli.py intentions --demand 120 180 240 --nested
+    python cli.py alternatives --k 3
+    python cli.py plan --dof 4D
+    python cli.py strategic
+    python cli.py analyse Standard
+    python cli.py experiments
+    python cli.py validate
+    python cli.py batches --num-splits 4
+
+The routes, intentions, alternatives, plan, strategic and experiments stages take
+--shard i/N (0 <= i < N) to only do their part of the work, such that N nodes on a
+shared filesystem can split a job. With intentions --shard-flights, the shards split
+the flights of every file instead, and 'merge --shards N' stitches the parts together.
+
+With --compression gzip or zstd, the intentions, strategic and experiments stages write
+and reference compressed base scenarios. BlueSky then needs the plugin in
+plugins/m22_compressed_scn.py to call them.
+"""
+import argparse
+
+from sharding import parse_shard
+
+def run_origins(args):
+    import pickle_maker
+    if args.city is not None:
+        pickle_maker.path = args.city
+    pickle_maker.make_origins()
+
+def run_routes(args):
+    import pickle_maker
+    if args.city is not None:
+        pickle_maker.path = args.city
+    if args.num_cpu is not None:
+        pickle_maker.num_cpu = args.num_cpu
+    pickle_maker.shard = args.shard
+    pickle_maker.make_routes()
+
+def run_intentions(args):
+    from intention_maker import IntentionMaker
+    import tqdm
+    maker = IntentionMaker()
+    if args.num_cpu is not None:
+        maker.num_cpu = args.num_cpu
+    maker.shard = args.shard
+    maker.shard_flights = args.shard_flights
+    maker.compression = args.compression
+    maker.nested_demand = args.nested
+    if args.demand is not None:
+        maker.traffic_demand_levels = args.demand
+    maker.mission_distance = args.mission_distance
+    if args.timespan is not None:
+        maker.intention_timespan = args.timespan
+    if args.update:
+        # Extend the existing files, or regenerate a window of them
+        start = None if args.start is None else args.start * 60
+        end = None if args.end is None else args.end * 60
+        try:
+            for imp in tqdm.tqdm(maker.get_intention_jobs()):
+                maker.update_intention(imp, start, end)
+        except FileNotFoundError as e:
+            raise SystemExit(e)
+        return
+    maker.make_intentions_mp()
+
+def run_alternatives(args):
+    from route_alternatives import RouteAlternativesMaker
+    maker = RouteAlternativesMaker()
+    maker.method = args.method
+    maker.num_alternatives = args.k
+    if args.num_cpu is not None:
+        maker.num_cpu = args.num_cpu
+    maker.shard = args.shard
+    maker.make_all_alternatives()
+
+def run_plan(args):
+    from strategic_planner import StrategicPlanner
+    planner = StrategicPlanner(args.routing_backend)
+    planner.dof = args.dof
+    if args.num_cpu is not None:
+        planner.num_cpu = args.num_cpu
+    planner.shard = args.shard
+    planner.plan_all_intentions()
+
+def run_strategic(args):
+    from strategic_maker import StrategicScenarioMaker
+    maker = StrategicScenarioMaker()
+    if args.num_cpu is not None:
+        maker.num_cpu = args.num_cpu
+    maker.shard = args.shard
+    maker.compression = args.compression
+    maker.create_all_scenarios_from_strategic()
+
+def run_analyse(args):
+    from traffic_analysis import TrafficAnalyser
+    analyser = TrafficAnalyser()
+    if args.num_cpu is not None:
+        analyser.num_cpu = args.num_cpu
+    analyser.analyse_all(args.folder)
+
+def run_experiments(args):
+    from scenario_maker import ScenarioMaker
+    maker = ScenarioMaker()
+    maker.shard = args.shard
+    maker.compression = args.compression
+    if args.timespan is not None:
+        maker.intention_timespan = args.timespan
+    maker.create_experiment_scenarios()
+
+def run_merge(args):
+    from sharding import merge_all_shards
+    for folder in args.folders:
+        # Only the scenarios are compressed, the intentions are read by the other stages
+        compression = args.compression if 'Base_Scenarios' in folder else None
+        merge_all_shards(folder, args.shards, compression)
+    if args.routes:
+        import pickle_maker
+        if args.city is not None:
+            pickle_maker.path = args.city
+        pickle_maker.load_graph()
+        pickle_maker.make_orig_dest_dict()
+
+def run_validate(args):
+    from scenario_validator import ScenarioValidator
+    validator = ScenarioValidator()
+    if args.num_cpu is not None:
+        validator.num_cpu = args.num_cpu
+    reports = validator.validate_all()
+    # Fail the job if any file has errors
+    if any(any(value for key, value in report.items() if key != 'num_flights') for report in reports.values()):
+        raise SystemExit(1)
+
+def run_batches(args):
+    import batch_maker
+    batch_maker.make_batches(args.path, args.num_splits)
+
+def make_parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(description = 'VLL airspace scenario generator for BlueSky.')
+    subparsers = parser.add_subparsers(dest = 'command', required = True)
+
+    origins = subparsers.add_parser('origins', help = 'Select the spawn points of a city.')
+    origins.add_argument('--city', default = None, help = 'Folder of the city graph.')
+    origins.set_defaults(func = run_origins)
+
+    routes = subparsers.add_parser('routes', help = 'Make the route pickles from the spawn points.')
+    routes.add_argument('--city', default = None, help = 'Folder of the city graph.')
+    routes.set_defaults(func = run_routes)
+
+    intentions = subparsers.add_parser('intentions', help = 'Make the flight intentions and standard scenarios.')
+    intentions.add_argument('--mission-distance', default = 'straight', choices = ['straight', 'network'],
+                            help = 'Filter the missions on straight line or network distance. Network '
+                                   'distances limit the origins to those of orig_dest_dict.pickle.')
+    intentions.add_argument('--demand', type = int, nargs = '+', default = None,
+                            help = 'Demand levels [aircraft/min], for example --demand 120 180 240.')
+    intentions.add_argument('--nested', action = 'store_true',
+                            help = 'Make the lower demand levels as subsets of the highest one.')
+    intentions.add_argument('--timespan', type = int, default = None, help = 'Length of the intentions [min].')
+    intentions.add_argument('--update', action = 'store_true',
+                            help = 'Extend the existing intentions to the timespan, or regenerate --start to --end.')
+    intentions.add_argument('--start', type = float, default = None, help = 'Start of the window to regenerate [min].')
+    intentions.add_argument('--end', type = float, default = None, help = 'End of the window to regenerate [min].')
+    intentions.set_defaults(func = run_intentions)
+
+    alternatives = subparsers.add_parser('alternatives', help = 'Make k alternative routes per flight intention.')
+    alternatives.add_argument('--k', type = int, default = 3, help = 'Number of routes per flight.')
+    alternatives.add_argument('--method', default = 'plateau', choices = ['plateau', 'penalty'])
+    alternatives.set_defaults(func = run_alternatives)
+
+    plan = subparsers.add_parser('plan', help = 'Make strategic .out files with the built-in planner.')
+    plan.add_argument('--dof', default = '4D', choices = ['1D', '2D', '4D'], help = 'Degrees of freedom of the plan.')
+    plan.add_argument('--routing-backend', default = 'scipy', choices = ['networkx', 'scipy', 'alt', 'bialt'],
+                      help = 'Router of the flight routes.')
+    plan.set_defaults(func = run_plan)
+
+    strategic = subparsers.add_parser('strategic', help = 'Convert strategic .out files to base scenarios.')
+    strategic.set_defaults(func = run_strategic)
+
+    analyse = subparsers.add_parser('analyse', help = 'Estimate the density and LoS of base scenarios.')
+    analyse.add_argument('folder', help = 'Base scenario folder, like Standard or 4D.')
+    analyse.set_defaults(func = run_analyse)
+
+    experiments = subparsers.add_parser('experiments', help = 'Make the experiment scenario files.')
+    experiments.add_argument('--timespan', type = int, default = None, 
+                             help = 'Length of the intentions [min], for the manifest if they are not made yet.')
+    experiments.set_defaults(func = run_experiments)
+
+    validate = subparsers.add_parser('validate', help = 'Check the intentions, base scenarios and experiment files.')
+    validate.set_defaults(func = run_validate)
+
+    for subparser in [routes, intentions, alternatives, plan, strategic, analyse, validate]:
+        subparser.add_argument('--num-cpu', type = int, default = None, help = 'Number of processes.')
+
+    for subparser in [routes, intentions, alternatives, plan, strategic, experiments]:
+        subparser.add_argument('--shard', type = parse_shard, default = None, help = 'Only do shard i of N, as i/N.')
+    for subparser in [intentions, strategic, experiments]:
+        subparser.add_argument('--compression', default = None, choices = ['gzip', 'zstd'],
+                               help = 'Compress the base scenarios.')
+    intentions.add_argument('--shard-flights', action = 'store_true', help = 'Shard the flights of every file instead of the files.')
+
+    merge = subparsers.add_parser('merge', help = 'Merge the intentions made with --shard-flights.')
+    merge.add_argument('--shards', type = int, required = True, help = 'Number of shards N.')
+    merge.add_argument('--folders', nargs = '+', default = ['Vienna/Intentions', 'Vienna/Base_Scenarios/Standard'],
+                       help = 'Folders with the parts to merge.')
+    merge.add_argument('--compression', default = None, choices = ['gzip', 'zstd'],
+                       help = 'Compress the merged base scenarios.')
+    merge.add_argument('--routes', action = 'store_true', help = 'Also make the orig_dest_dict of sharded routes.')
+    merge.add_argument('--city', default = None, help = 'Folder of the city graph for --routes.')
+    merge.set_defaults(func = run_merge)
+
+    batches = subparsers.add_parser('batches', help = 'Split the experiment scenarios in batch files.')
+    batches.add_argument('--path', default = 'Vienna/M2.2', help = 'Folder of the experiment scenarios.')
+    batches.add_argument('--num-splits', type = int, default = 4, help = 'Number of batch files.')
+    batches.set_defaults(func = run_batches)
+    return parser
+
+def main(argv = None):
+    args = make_parser().parse_args(argv)
+    args.func(args)
+    return
+
+if __name__ == "__main__":
+    main()
@@ -1,18 +1,44 @@
 import osmnx as ox
 import numpy as np
-import networkx as nx
-from shapely.ops import linemerge
-from shapely.geometry import MultiLineString, LineString
-import geopandas as gpd
 import random
 import time
 import copy
 import os
-import matplotlib.pyplot as plt
 import tqdm
+import pickle
+import re
 
-from multiprocessing import Pool
+from multiprocessing import Pool, Barrier
 
+from routing import make_router, build_distance_matrix, NetworkDistanceMatrix
+from route_geometry import RouteGeometry
+from scn_format import WaypointSerializer
+from sharding import shard_items, in_shard, shard_part_path, merge_all_shards
+from async_writer import get_writer, open_compressed, COMPRESSION_SUFFIX
+
+# The intention maker of a pool worker, set once by init_worker
+worker_maker = None
+# Barrier of all the workers of the pool, such that each of them flushes once at the end
+worker_barrier = None
+
+def init_worker(maker, barrier = None):
+    """Pool initializer, gives the worker its own copy of the maker once, instead of
+    sending the maker and its graph along with every task."""
+    global worker_maker, worker_barrier
+    worker_maker = maker
+    worker_barrier = barrier
+    return
+
+def make_one_intention_worker(imp):
+    # The files of the previous tasks are still being written, only fail on the errors so far
+    get_writer().check()
+    return worker_maker.make_one_intention(imp)
+
+def flush_worker(_):
+    # Every worker takes one of these tasks, as none returns before all of them have one
+    worker_barrier.wait()
+    get_writer().flush()
+    return
     
 class IntentionMaker:
     def __init__(self) -> None:
@@ -23,26 +49,64 @@ class IntentionMaker:
         self.min_mission_distance = 1000 #metres
         self.max_mission_distance = 5000 #metres
         self.intention_timespan = 90 # minutes
+        # Whether the mission distance is the 'straight' line distance or the 'network'
+        # distance along the street graph. Network distances come from a matrix with a row
+        # per origin of orig_dest_dict.pickle, so the origins are limited to those nodes.
+        self.mission_distance = 'straight'
         self.min_distance_between_origins = 200 #metres
         self.num_origins = 400
-        random.seed(0)
-        np.random.seed(0)
+        self.seed = 0
+        random.seed(self.seed)
+        np.random.seed(self.seed)
         self.layer_height = 50 #ft
         self.max_altitude = 500
         self.speed = 30
         self.planning_time_step = 15 #seconds
+        # Number of decimals in the scenario files
+        self.latlon_decimals = 7
+        self.hdg_decimals = 1
+        self.serializer = WaypointSerializer(self.latlon_decimals, self.hdg_decimals)
+        # Compression of the scenario files, None, 'gzip' or 'zstd'
+        self.compression = None
         
         # City related parameters
         self.city = 'Vienna' # City name
         self.path = f'{self.city}' # Folder path
         self.intention_path = self.path + '/Intentions'
-        self.scenario_path = self.path + '/Base Scenarios/Standard'
+        self.scenario_path = self.path + '/Base_Scenarios/Standard'
         self.G = ox.load_graphml(f'{self.path}/streets.graphml') # Load the street graph
         self.nodes, self.edges = ox.graph_to_gdfs(self.G) # Load the nodes and edges from the graph
         
+        # Routing backend, 'networkx', 'scipy', or 'alt'/'bialt' for A* with landmarks
+        self.routing_backend = 'networkx'
+        self.router = make_router(self.G, self.routing_backend, 
+                                  landmark_path = f'{self.path}/landmarks.npz')
+        
+        # Packed edge coordinates to assemble the route geometries from
+        self.route_geometry = RouteGeometry(self.G)
+        
+        # Network distances from the origins in orig_dest_dict, to filter missions on.
+        # Loaded by get_distance_matrix when the network mission distance is used.
+        self.distance_matrix = None
+        
         # Num cpu
         self.num_cpu = 1
         
+        # Sharding over multiple invocations, (i, N) or None. Either the intention files
+        # are divided over the shards, or if shard_flights is True, the flights of every
+        # file, after which merge_intentions stitches the parts together.
+        self.shard = None
+        self.shard_flights = False
+        
+        # Checkpoints of the sampler state at every planning time step, such that
+        # update_intention can later extend a file or regenerate part of it
+        self.checkpoint_path = self.path + '/Checkpoints'
+        self.save_checkpoints = True
+        
+        # Nested demand levels. Only the highest demand level is generated and routed, and
+        # the lower ones are evenly thinned subsets of it in every planning time step.
+        self.nested_demand = False
+        
     def make_intentions(self) -> None:
         """Function that creates the intentions and saves them in files in function of the
         parameters given in the init function.
@@ -50,21 +114,13 @@ class IntentionMaker:
         # First, make an intention directory if there is none.
         os.makedirs(self.intention_path, exist_ok=True)
         os.makedirs(self.scenario_path, exist_ok=True)
+        if self.mission_distance == 'network':
+            self.get_distance_matrix()
         # Then, we for loop over demand levels and repetitions
-        for demand in self.traffic_demand_levels:
-            for repetition in range(self.repetitions_per_demand_level):
-                # Get origins and destinations
-                origins, destinations = self.create_origins_destinations()
-                # Get the intention data
-                intention_data, scenario_data = self.create_intention(demand, origins, destinations)
-                # Create the file and write to it
-                with open(self.intention_path + f'/Flight_intention_{demand}_{repetition+1}.txt', 'w') as f:
-                    for line in intention_data:
-                        f.write(';'.join(line) + '\n')
-                        
-                with open(self.scenario_path + f'/Flight_intention_{demand}_{repetition+1}.scn', 'w') as f:
-                    for line in scenario_data:
-                        f.write(line)
+        for imp in self.get_intention_jobs():
+            self.make_one_intention(imp)
+        # Wait until the background writer has written everything
+        get_writer().flush()
         return
     
     def make_intentions_mp(self) -> None:
@@ -74,30 +130,257 @@ class IntentionMaker:
         # First, make an intention directory if there is none.
         os.makedirs(self.intention_path, exist_ok=True)
         os.makedirs(self.scenario_path, exist_ok=True)
+        # Load or build the distance matrix once, before the workers get a copy of the maker
+        if self.mission_distance == 'network':
+            self.get_distance_matrix()
         # Then, we for loop over demand levels and repetitions
+        imp_arr = self.get_intention_jobs()
+                
+        barrier = Barrier(self.num_cpu)
+        with Pool(self.num_cpu, initializer = init_worker, initargs = (self, barrier)) as p:
+            print(list(tqdm.tqdm(p.imap(make_one_intention_worker, imp_arr), total = len(imp_arr))))
+            # Wait for the files in every worker, such that write errors fail this call
+            p.map(flush_worker, range(self.num_cpu), chunksize = 1)
+            # Close instead of terminate, such that the workers finish writing
+            p.close()
+            p.join()
+        return
+    
+    def get_intention_jobs(self) -> list:
+        """Gives the [demand, repetition] of the intention files to make. When sharding by file,
+        only the ones of this shard. With nested demand levels, only the highest demand level,
+        which makes the lower ones as well."""
         imp_arr = []
-        for demand in self.traffic_demand_levels:
+        demand_levels = [max(self.traffic_demand_levels)] if self.nested_demand else self.traffic_demand_levels
+        for demand in demand_levels:
             for repetition in range(self.repetitions_per_demand_level):
                 imp_arr.append([demand, repetition])
-                
-        with Pool(self.num_cpu) as p:
-            print(list(tqdm.tqdm(p.imap(self.make_one_intention, imp_arr), total = len(imp_arr))))
-        return
+        if self.shard_flights:
+            # Every shard does all files, but only part of the flights
+            return imp_arr
+        return shard_items(imp_arr, self.shard)
     
     def make_one_intention(self, imp):
         demand, repetition = imp
+        # Seed per file, such that a file does not depend on which process or shard makes it
+        random.seed(self.seed * 1000003 + demand * 1000 + repetition)
+        np.random.seed(self.seed * 1000003 + demand * 1000 + repetition)
         origins, destinations = self.create_origins_destinations()
-        intention_data, scenario_data = self.create_intention(demand, origins, destinations)
-        # Create the file and write to it
-        with open(self.intention_path + f'/Flight_intention_{demand}_{repetition+1}.txt', 'w') as f:
+        sharded_flights = self.shard_flights and self.shard is not None
+        if self.nested_demand and sharded_flights:
+            raise ValueError('Nested demand levels need whole files, shard the files instead of the flights.')
+        # The checkpoints only make sense for whole files
+        save_checkpoints = self.save_checkpoints and not sharded_flights
+        states = [] if save_checkpoints or self.nested_demand else None
+        intention_data, scenario_data = self.create_intention(demand, origins, destinations,
+                                                              checkpoints = states)
+        if save_checkpoints:
+            self.save_checkpoint(demand, repetition, {'origins': origins, 'destinations': destinations,
+                                                      'states': states})
+        self.write_intention(demand, repetition, intention_data, scenario_data)
+        if self.nested_demand:
+            self.write_lower_demand_levels(demand, repetition, intention_data, scenario_data, states)
+        return
+    
+    def write_lower_demand_levels(self, demand: int, repetition: int, intention_data: list, 
+                                  scenario_data: list, states: list) -> None:
+        """Writes the lower demand levels of a nested intention, which reuse the flights and
+        routes of the given one."""
+        for lower_demand in self.traffic_demand_levels:
+            if lower_demand < demand:
+                # Their flights are not sampled, so they cannot be updated on their own
+                checkpoint_filename = self.checkpoint_path + f'/Flight_intention_{lower_demand}_{repetition+1}.pickle'
+                if os.path.exists(checkpoint_filename):
+                    os.remove(checkpoint_filename)
+                self.write_intention(lower_demand, repetition,
+                                     *self.thin_intention(lower_demand, intention_data, scenario_data, states))
+        return
+    
+    def write_intention(self, demand: int, repetition: int, intention_data: list, scenario_data: list) -> None:
+        """Writes an intention file and its scenario file."""
+        intention_filename, scenario_filename = self.get_intention_filenames(demand, repetition)
+        compression = self.compression
+        # Each shard writes its own part of the files, merge_intentions stitches them
+        if self.shard_flights and self.shard is not None:
+            intention_filename = shard_part_path(intention_filename, self.shard)
+            scenario_filename = shard_part_path(scenario_filename, self.shard)
+            # The parts are merged as text
+            compression = None
+        # Hand the files to the background writer, which renames them when they are complete
+        writer = get_writer()
+        with writer.open(intention_filename) as f:
             for line in intention_data:
                 f.write(';'.join(line) + '\n')
                 
-        with open(self.scenario_path + f'/Flight_intention_{demand}_{repetition+1}.scn', 'w') as f:
+        with writer.open(scenario_filename, compression) as f:
             for line in scenario_data:
                 f.write(line)
+        return
+    
+    def thin_intention(self, demand: int, intention_data: list, scenario_data: list, states: list) -> tuple:
+        """Gives a lower demand level of an intention by keeping an evenly spread subset of the
+        flights of every planning time step, and renumbering them. The spawn times, nodes and
+        routes are those of the higher demand level.
+
+        Args:
+            demand (int): The lower demand level, aircraft per minute.
+            intention_data (list): The split intention lines of the higher demand level.
+            scenario_data (list): The scenario lines of the higher demand level.
+            states (list): The checkpoint states of the higher demand level.
+
+        Returns:
+            tuple: The intention and scenario data of the lower demand level.
+        """
+        scaled_demand = int(self.planning_time_step/60 * demand)
+        flight_idx = []
+        for state, next_state in zip(states[:-1], states[1:]):
+            num_flights = next_state['num_flights'] - state['num_flights']
+            num_keep = min(scaled_demand, num_flights)
+            flight_idx += (state['num_flights'] + np.round(np.linspace(0, num_flights - 1, num_keep)).astype(int)).tolist()
+        thin_intention_data = []
+        thin_scenario_data = []
+        for acidx, i in enumerate(flight_idx, start = 1):
+            thin_intention_data.append([f'D{acidx}'] + intention_data[i][1:])
+            thin_scenario_data.append(self.replace_acid(scenario_data[i], f'D{acidx}'))
+        return thin_intention_data, thin_scenario_data
+    
+    def get_intention_filenames(self, demand: int, repetition: int) -> tuple:
+        """Gives the paths of the intention and scenario file, without compression suffix."""
+        intention_filename = self.intention_path + f'/Flight_intention_{demand}_{repetition+1}.txt'
+        scenario_filename = self.scenario_path + f'/Flight_intention_{demand}_{repetition+1}.scn'
+        return intention_filename, scenario_filename
+    
+    def save_checkpoint(self, demand: int, repetition: int, checkpoint: dict) -> None:
+        """Saves the origins, destinations and sampler states of an intention file."""
+        os.makedirs(self.checkpoint_path, exist_ok=True)
+        filename = self.checkpoint_path + f'/Flight_intention_{demand}_{repetition+1}.pickle'
+        with open(filename + '.tmp', 'wb') as f:
+            pickle.dump(checkpoint, f)
+        os.replace(filename + '.tmp', filename)
+        return
+    
+    def load_checkpoint(self, demand: int, repetition: int) -> dict:
+        filename = self.checkpoint_path + f'/Flight_intention_{demand}_{repetition+1}.pickle'
+        if not os.path.exists(filename):
+            raise FileNotFoundError(f'No checkpoint {filename}. The intention was made without checkpoints, '
+                                    'or derived from a higher demand level with nested_demand, in which case '
+                                    'update that level with nested_demand instead.')
+        with open(filename, 'rb') as f:
+            return pickle.load(f)
+    
+    def update_intention(self, imp, start_time: float = None, end_time: float = None) -> None:
+        """Extends an existing intention and scenario file, or regenerates a time window of
+        it, starting from the sampler state that make_one_intention saved for that planning
+        time step. The flights before the window are kept as they are, and so are the ones
+        after it, which are only renumbered if the window has a different number of flights.
+        The last step of the window does not spawn at the nodes of the first step after it.
+        The parameters, like the demand or the mission distances, can be changed for the
+        window only. Extending a file needs a larger intention_timespan. With nested_demand,
+        the lower demand levels are derived again from the updated file.
+
+        Args:
+            imp (list): [demand, repetition] of the file.
+            start_time (float): Start of the window [s], rounded down to a planning time
+            step. The end of the existing file if None, which extends it.
+            end_time (float): End of the window [s], rounded up to a planning time step.
+            The intention timespan if None or within the last step, which replaces all the
+            flights after start_time.
+        """
+        demand, repetition = imp
+        checkpoint = self.load_checkpoint(demand, repetition)
+        states = checkpoint['states']
+        file_end = states[-1]['timestamp']
+        if start_time is None:
+            start_time = file_end
+        # The state at the start of the window
+        start_idx = max(i for i, state in enumerate(states) if state['timestamp'] <= start_time)
+        start_state = states[start_idx]
+        # The flights after the window are kept if it ends before the last planning time
+        # step of the file, otherwise it runs to the end of the file
+        if end_time is not None and end_time < file_end:
+            end_idx = min(i for i, state in enumerate(states) if state['timestamp'] >= end_time)
+        else:
+            end_idx = len(states) - 1
+        if end_idx < len(states) - 1:
+            tail_states = states[end_idx:]
+            end_time = tail_states[0]['timestamp']
+            # The spawn nodes of the first step after the window
+            next_used_nodes = tail_states[1]['prev_used_nodes']
+        else:
+            tail_states = []
+            end_time = self.intention_timespan * 60
+            next_used_nodes = None
+        
+        intention_filename, scenario_filename = self.get_intention_filenames(demand, repetition)
+        scenario_filename_full = scenario_filename + COMPRESSION_SUFFIX[self.compression]
+        with open(intention_filename, 'r') as f:
+            intention_lines = f.readlines()
+        with open_compressed(scenario_filename_full, 'rt') as f:
+            scenario_lines = f.readlines()
+        
+        # Make the flights of the window
+        new_states = []
+        intention_data, scenario_data = self.create_intention(demand, checkpoint['origins'], 
+                                                              checkpoint['destinations'], start_state, 
+                                                              end_time, new_states, next_used_nodes)
+        num_head = start_state['num_flights']
+        for state in new_states:
+            state['num_flights'] += num_head
+        intention_text = intention_lines[:num_head] + [';'.join(line) + '\n' for line in intention_data]
+        scenario_text = scenario_lines[:num_head] + scenario_data
+        if tail_states:
+            # Keep the flights after the window, and their states, with shifted numbers
+            end_state = new_states.pop()
+            acid_shift = end_state['acidx'] - tail_states[0]['acidx']
+            line_shift = end_state['num_flights'] - tail_states[0]['num_flights']
+            num_tail = tail_states[0]['num_flights']
+            intention_text += [self.renumber_line(line, acid_shift) for line in intention_lines[num_tail:]]
+            scenario_text += [self.renumber_line(line, acid_shift) for line in scenario_lines[num_tail:]]
+            for state in tail_states:
+                state['acidx'] += acid_shift
+                state['num_flights'] += line_shift
+            tail_states[0]['prev_used_nodes'] = end_state['prev_used_nodes']
+            new_states += tail_states
         
+        # Write the files and the updated checkpoint
+        writer = get_writer()
+        with writer.open(intention_filename) as f:
+            f.write(''.join(intention_text))
+        with writer.open(scenario_filename, self.compression) as f:
+            f.write(''.join(scenario_text))
+        writer.flush()
+        checkpoint['states'] = states[:start_idx] + new_states
+        self.save_checkpoint(demand, repetition, checkpoint)
+        if self.nested_demand:
+            self.write_lower_demand_levels(demand, repetition, [line.rstrip('\n').split(';') for line in intention_text],
+                                           scenario_text, checkpoint['states'])
+            writer.flush()
+        return
+    
+    @staticmethod
+    def renumber_line(line: str, acid_shift: int) -> str:
+        """Shifts the number of the ACID of an intention or scenario line."""
+        if acid_shift == 0:
+            return line
+        if '>M22CRE ' in line:
+            acid = line.split('>M22CRE ', 1)[1].split(',', 1)[0]
+        else:
+            acid = line.split(';', 1)[0]
+        return IntentionMaker.replace_acid(line, f'D{int(acid[1:]) + acid_shift}')
     
+    @staticmethod
+    def replace_acid(line: str, acid: str) -> str:
+        """Replaces the ACID of an intention or scenario line."""
+        if '>M22CRE ' in line:
+            return re.sub(r'>M22CRE [^,]+,', f'>M22CRE {acid},', line, count = 1)
+        return f'{acid};{line.split(";", 1)[1]}'
+    
+    def merge_intentions(self, num_shards: int) -> None:
+        """Merges the intention and scenario files that were made by num_shards flight shards."""
+        merge_all_shards(self.intention_path, num_shards)
+        merge_all_shards(self.scenario_path, num_shards, self.compression)
+        return
+        
     def make_default_scenarios(self) -> None:
         """Function that, given the existence of intentions, creates baseline scenarios
         where aircraft just take the shortest route."""
@@ -118,6 +401,26 @@ class IntentionMaker:
                     scen_line = self.get_scenario_line(split[0], split[2], int(split[3]), int(split[4]))
                     f.write(scen_line)
         
+    def get_distance_matrix(self) -> NetworkDistanceMatrix:
+        """Gives the network distance matrix, which is loaded the first time."""
+        if self.distance_matrix is None:
+            self.distance_matrix = self.load_distance_matrix()
+            num_matrix_origins = len(self.distance_matrix.origins)
+            if num_matrix_origins < self.num_origins:
+                print(f'Network mission distances: the origins are limited to the {num_matrix_origins} '
+                      f'nodes in the distance matrix, fewer than num_origins = {self.num_origins}.')
+        return self.distance_matrix
+    
+    def load_distance_matrix(self) -> NetworkDistanceMatrix:
+        """Loads the network distance matrix, and creates it first if needed for the origins
+        in orig_dest_dict.pickle."""
+        matrix_path = f'{self.path}/orig_dest_dist.npy'
+        if not os.path.exists(matrix_path):
+            with open(f'{self.path}/orig_dest_dict.pickle', 'rb') as f:
+                orig_dest_dict = pickle.load(f)
+            build_distance_matrix(self.G, list(orig_dest_dict.keys()), matrix_path)
+        return NetworkDistanceMatrix(matrix_path)
+        
     def kwikdist(self, lata: float, lona: float, latb:float, lonb:float) -> float:
         """Gives quick and dirty dist [m]
         from lat/lon. (note: does not work well close to poles)"""
@@ -142,13 +445,20 @@ class IntentionMaker:
 
         return qdr
 
-    def create_intention(self, demand: float, origins: list, destinations: list) -> list:
+    def create_intention(self, demand: float, origins: list, destinations: list, state: dict = None,
+                         end_time: float = None, checkpoints: list = None, next_used_nodes: list = None) -> list:
         """Creates a single flight intention file.
 
         Args:
             demand (float): Number of aircraft per minute.
             origins (list): List of origin nodes to use.
             destinations (list): List of destination nodes to use.
+            state (dict): Checkpoint state to start from, timestamp 0 if None.
+            end_time (float): Time [s] at which to stop, the intention timespan if None.
+            checkpoints (list): If given, the state at the start of every planning time
+            step and at the end is appended to it.
+            next_used_nodes (list): The spawn nodes of the step at end_time, when the flights
+            after end_time already exist. The last step does not spawn at them.
             
         Returns:
             intention (tuple): A tuple with each entry representing a flight intention
@@ -158,16 +468,27 @@ class IntentionMaker:
         priority = '1'
         # We basically want to go minute by minute and try to fit the required amount of traffic,
         # spawning them at different nodes.
-        # We start at timestamp 0
-        timestamp = 0 #Seconds
+        # We start at timestamp 0, or from a checkpoint
+        if state is None:
+            state = {'timestamp': 0, 'acidx': 1, 'prev_used_nodes': []}
+        elif 'random_state' in state:
+            random.setstate(state['random_state'])
+        if end_time is None:
+            end_time = self.intention_timespan * 60
+        timestamp = state['timestamp'] #Seconds
         # Increment for ACID
-        acidx = 1
+        acidx = state['acidx']
         # Check prev_used_nodes
-        prev_used_nodes = []
+        prev_used_nodes = state['prev_used_nodes']
         # Flight data
         flight_intention_data = []
         flight_scenario_data = []
-        while timestamp < self.intention_timespan * 60:
+        # Let the router prepare the shortest path trees of the origins if it can
+        self.router.precompute(origins)
+        while timestamp < end_time:
+            if checkpoints is not None:
+                checkpoints.append(self.get_checkpoint_state(timestamp, acidx, prev_used_nodes, 
+                                                              len(flight_intention_data)))
             # Demand is per limit, scale it for the planning time step
             scaled_demand = int(self.planning_time_step/60 * demand)
             # Distribute the demand equally over this minute
@@ -177,6 +498,11 @@ class IntentionMaker:
             available_nodes = [node for node in origins if node not in prev_used_nodes]
             # Get a random sample from these nodes
             spawn_nodes = random.sample(available_nodes, scaled_demand)
+            # The last step must not use the nodes of the step after it either
+            if (next_used_nodes and timestamp + self.planning_time_step >= end_time
+                    and not set(spawn_nodes).isdisjoint(next_used_nodes)):
+                available_nodes = [node for node in available_nodes if node not in next_used_nodes]
+                spawn_nodes = random.sample(available_nodes, scaled_demand)
             # Loop through these nodes and spawn aircraft these aircraft within a minute
             for i, spawn_node in enumerate(spawn_nodes):
                 # Get the coordinates of the nodes
@@ -188,13 +514,24 @@ class IntentionMaker:
                     destination_node = random.choice(destinations)
                     destination_node_lat = self.G.nodes[destination_node]['y']
                     destination_node_lon = self.G.nodes[destination_node]['x']
-                    dist_between_nodes = self.kwikdist(spawn_node_lat, spawn_node_lon, 
-                                                       destination_node_lat, destination_node_lon)
+                    if self.mission_distance == 'network':
+                        dist_between_nodes = self.get_distance_matrix().distance(spawn_node, destination_node)
+                    else:
+                        dist_between_nodes = self.kwikdist(spawn_node_lat, spawn_node_lon, 
+                                                           destination_node_lat, destination_node_lon)
                     
                     if self.min_mission_distance < dist_between_nodes <self.max_mission_distance:
                         # We're good
                         break
                     
+                # Pick the altitude here, such that all shards draw the same random numbers
+                alt = random.choice(self.get_altitudes())
+                
+                # Only the flights of this shard are routed and saved
+                if self.shard_flights and not in_shard(acidx - 1, self.shard):
+                    acidx += 1
+                    continue
+                    
                 # We now have a destination. Can now append the flight intention data array with this flight
                 spawn_time_seconds = time_range[i]
                 acid = f'D{acidx}'
@@ -204,7 +541,7 @@ class IntentionMaker:
                 
                 flight_intention_data.append([acid, ac_model, spawn_time_hhmmss, str(spawn_node), str(destination_node), priority])
                 # Get flight scenario data
-                flight_scenario_data.append(self.get_scenario_line(acid, spawn_time_hhmmss, spawn_node, destination_node))
+                flight_scenario_data.append(self.get_scenario_line(acid, spawn_time_hhmmss, spawn_node, destination_node, alt))
                 # Increment acid by 1
                 acidx += 1
             
@@ -212,87 +549,52 @@ class IntentionMaker:
             timestamp += self.planning_time_step
             # Overwrite the previously used nodes
             prev_used_nodes = copy.copy(spawn_nodes)
+        
+        # The state at the end, from which the file can be extended
+        if checkpoints is not None:
+            checkpoints.append(self.get_checkpoint_state(timestamp, acidx, prev_used_nodes, 
+                                                          len(flight_intention_data)))
             
         # At the end, return the data
         return flight_intention_data, flight_scenario_data
     
-    def get_scenario_line(self, acid: str, spawn_time: str, spawn_node: int, dest_node: int) -> str:
-        # Get possible spawning altitudes
-        altitudes = np.arange(self.layer_height, self.max_altitude, self.layer_height)
-        # Pick a random one
-        alt = random.choice(altitudes)
-        # Create the path for these two nodes
-        route = nx.shortest_path(self.G, spawn_node, dest_node, weight = 'length')
-        # Extract the path geometry
-        geoms = [self.edges.loc[(u, v, 0), 'geometry'] for u, v in zip(route[:-1], route[1:])]
-        rounded_geoms = []
-        # Round coords
-        for geom in geoms:
-            coords = np.round(np.array(geom.xy).T, 7)
-            rounded_geoms.append(LineString(coords))
-            
-        street_numbers = [self.edges.loc[(u, v, 0), 'stroke'] for u, v in zip(route[:-1], route[1:])]
-        line = linemerge(rounded_geoms)
-
-        if type(line) == MultiLineString:
-            for l in line.geoms:
-                plt.plot(l.xy[0],l.xy[1])
-            plt.show()
+    def get_checkpoint_state(self, timestamp: float, acidx: int, prev_used_nodes: list, 
+                             num_flights: int) -> dict:
+        """Gives everything the sampler needs to continue from a planning time step."""
+        return {'timestamp': timestamp, 'acidx': acidx, 'prev_used_nodes': list(prev_used_nodes),
+                'num_flights': num_flights, 'random_state': random.getstate()}
+    
+    def get_altitudes(self) -> np.ndarray:
+        """Gives the possible spawning altitudes."""
+        return np.arange(self.layer_height, self.max_altitude, self.layer_height)
         
-        # Prepare the edges
-        point_street_no = []
-        i = 0
-        for geom, u, v in zip(geoms, route[:-1], route[1:]):
-            if i == 0:
-                # First edge, also take the first waypoint
-                for coord in geom.coords:
-                    point_street_no.append(street_numbers[i])
-            else:
-                first = True
-                for coord in geom.coords:
-                    if first:
-                        first = False
-                        continue
-                    point_street_no.append(street_numbers[i])
-            i += 1
+    def get_scenario_line(self, acid: str, spawn_time: str, spawn_node: int, dest_node: int, 
+                          alt: int = None) -> str:
+        # Pick a random altitude if none is given
+        if alt is None:
+            alt = random.choice(self.get_altitudes())
+        # Create the path for these two nodes
+        route = self.router.shortest_path(spawn_node, dest_node)
+        # Assemble the path geometry from the packed edge coordinates
+        coords, _, point_street_no = self.route_geometry.assemble(route)
+        lats, lons = coords[:,1], coords[:,0]
         # Get initial heading
-        hdg = self.kwikqdr(line.xy[1][0], line.xy[0][0], line.xy[1][1], line.xy[0][1])
+        hdg = self.kwikqdr(lats[0], lons[0], lats[1], lons[1])
         # Initialise the scen_text
-        scen_text = f'{spawn_time}>M22CRE {acid},M600,{line.xy[1][0]},{line.xy[0][0]},{hdg},{alt},{self.speed},'
-                
-        # Also prepare the turns
-        latlons = list(zip(line.xy[1], line.xy[0]))
-        turns = [True] # Always make first wpt a turn
+        scen_text = self.serializer.format_cre(spawn_time, acid, lats[0], lons[0], hdg, alt, self.speed)
+        
+        # Prepare the turns for all the waypoints at once
+        d1 = self.kwikqdr(lats[:-2], lons[:-2], lats[1:-1], lons[1:-1])
+        d2 = self.kwikqdr(lats[1:-1], lons[1:-1], lats[2:], lons[2:])
+        angle = np.abs(d2 - d1)
+        angle = np.where(angle > 180, 360 - angle, angle)
+        # This is a turn if angle is greater than 25. First and last waypoint are always turns.
+        turns = np.ones(len(lats), dtype=bool)
+        turns[1:-1] = angle > 25
         # This text basically has the following order:
         # lat, lon, alt, spd, RTA, FLYTURN/FLYBY,street_number
         # For now, RTA is just nothing
-        scen_text += f'{line.xy[1][0]},{line.xy[0][0]},,,,FLYTURN,{point_street_no[0]}'
-        i = 1
-        for lat_cur, lon_cur in latlons[1:-1]:
-            # Get the needed stuff
-            lat_prev, lon_prev = latlons[i-1]
-            lat_next, lon_next = latlons[i+1]
-            
-            # Get the angle
-            d1=self.kwikqdr(lat_prev,lon_prev,lat_cur,lon_cur)
-            d2=self.kwikqdr(lat_cur,lon_cur,lat_next,lon_next)
-            angle=abs(d2-d1)
-
-            if angle>180:
-                angle=360-angle
-                
-            # This is a turn if angle is greater than 25
-            if angle > 25:
-                scen_text += f',{lat_cur},{lon_cur},,,,FLYTURN,{point_street_no[i]}'
-            else:
-                scen_text += f',{lat_cur},{lon_cur},,,,FLYBY,{point_street_no[i]}'
-                
-            i+= 1
-                
-        #Last waypoint is always a turn one.        
-        turns.append(True)
-        # Add the last waypoint
-        scen_text += f',{line.xy[1][-1]},{line.xy[0][-1]},,,,FLYTURN,{street_numbers[-1]}\n'
+        scen_text += self.serializer.format_waypoints(lats, lons, turns, point_street_no) + '\n'
         return scen_text
         
     def create_origins_destinations(self) -> tuple:
@@ -304,10 +606,15 @@ class IntentionMaker:
         # Let's make some origin and destinations from this graph
         origin_nodes = []
         attempts = 0
+        # With network distances, origins can only be the ones in the distance matrix
+        if self.mission_distance == 'network':
+            candidate_nodes = self.get_distance_matrix().origins
+        else:
+            candidate_nodes = list(self.G.nodes)
         # Maximum 100 attempts to select a node, and maximum 200 origin nodes
         while attempts < 100 and len(origin_nodes)<self.num_origins:
             # Select a node
-            node = random.choice(list(self.G.nodes))
+            node = random.choice(candidate_nodes)
             # Extract its coordinates
             node_lat = self.G.nodes[node]['y']
             node_lon = self.G.nodes[node]['x']
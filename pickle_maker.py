@@ -1,14 +1,15 @@
-import osmnx as ox
 import pickle
 import numpy as np
-import networkx as nx
-from shapely.ops import linemerge
 from multiprocessing import Pool
 import random
 import os
 from os.path import exists
 import tqdm
 
+from routing import make_router, build_distance_matrix
+from route_geometry import RouteGeometry
+from sharding import shard_items
+
 #Steal kiwkqdrdist function from Bluesky
 def kwikqdrdist(lata, lona, latb, lonb):
     """Gives quick and dirty qdr[deg] and dist [nm]
@@ -33,46 +34,96 @@ path = f'{city}'
 # Path requirements
 min_dist = 100 # Metres
 
-# Load the graph for that city
-G = ox.load_graphml(f'{path}/streets.graphml')
-nodes, edges = ox.graph_to_gdfs(G)
-
-# Let's make some origin and destinations from this graph
-nodes_already_added = []
-attempts = 0
-random.seed(0)
-while attempts < 100 and len(nodes_already_added)<200:
-    node = random.choice(list(G.nodes))
-    node_lat = G.nodes[node]['y']
-    node_lon = G.nodes[node]['x']
-    node_too_close = False
-    for existing_node in nodes_already_added:
-        existing_node_lat = G.nodes[existing_node]['y']
-        existing_node_lon = G.nodes[existing_node]['x']
-        _, dist = kwikqdrdist(node_lat, node_lon, existing_node_lat, existing_node_lon)
-        if dist < 200:
-            # Node too close
-            node_too_close = True
-            break
-    if not node_too_close:
-        nodes_already_added.append(node)
-        attempts = 0
-    else:
-        attempts += 1
-
-# Load the spawning points for that city, convert em to simple IDs
-orig_nodes = nodes_already_added
-orig_nodes_new = []
-
-# Compile the list of destination nodes
-dest_nodes = [x for x in G.nodes if x not in orig_nodes]
-dest_nodes_new = []
-            
-# Make the input array by combining all origin nodes with destination nodes
-input_arr = []
-for origin in orig_nodes:
-    for destination in dest_nodes:
-        input_arr.append([origin, destination])
+# Routing backend, 'networkx' or 'scipy'
+routing_backend = 'networkx'
+
+# Number of processes to make the pickles with
+num_cpu = 8
+
+# Sharding over multiple invocations, (i, N) or None for all the routes
+shard = None
+
+# The graph and what is derived from it, loaded by load_graph in the main process or
+# in the pool workers.
+G = None
+router = None
+route_geometry = None
+
+def load_graph():
+    """Loads the graph for the city, and prepares the router and edge coordinates."""
+    global G, router, route_geometry
+    import osmnx as ox
+    G = ox.load_graphml(f'{path}/streets.graphml')
+    # Routes are the shortest in length, like in the other makers. Fewest edges, which
+    # nx.shortest_path gives without a weight, has many equally short routes, and every
+    # backend would pick a different one.
+    router = make_router(G, routing_backend)
+    # Unrounded edge coordinates to assemble the route geometries from
+    route_geometry = RouteGeometry(G, decimals = None)
+    return
+
+def init_worker(city_path: str, backend: str, min_route_dist: float):
+    """Pool initializer, such that spawned workers use the settings of the main process."""
+    global path, routing_backend, min_dist
+    path, routing_backend, min_dist = city_path, backend, min_route_dist
+    # Forked workers inherit the graph of the main process, only spawned ones load it
+    if G is None:
+        load_graph()
+    return
+
+def select_origins() -> list:
+    """Selects up to 200 origin nodes that are at least 200 m apart."""
+    # Let's make some origin and destinations from this graph
+    nodes_already_added = []
+    attempts = 0
+    random.seed(0)
+    while attempts < 100 and len(nodes_already_added)<200:
+        node = random.choice(list(G.nodes))
+        node_lat = G.nodes[node]['y']
+        node_lon = G.nodes[node]['x']
+        node_too_close = False
+        for existing_node in nodes_already_added:
+            existing_node_lat = G.nodes[existing_node]['y']
+            existing_node_lon = G.nodes[existing_node]['x']
+            _, dist = kwikqdrdist(node_lat, node_lon, existing_node_lat, existing_node_lon)
+            if dist < 200:
+                # Node too close
+                node_too_close = True
+                break
+        if not node_too_close:
+            nodes_already_added.append(node)
+            attempts = 0
+        else:
+            attempts += 1
+    return nodes_already_added
+
+def make_origins() -> list:
+    """Selects the origins and saves them in spawn_points.txt, one node per line."""
+    if G is None:
+        load_graph()
+    orig_nodes = select_origins()
+    print(f'Found {len(orig_nodes)} spawn points.')
+    with open(f'{path}/spawn_points.txt', 'w') as f:
+        f.write(''.join(f'{node}\n' for node in orig_nodes))
+    return orig_nodes
+
+def load_origins() -> list:
+    """Loads the origins from spawn_points.txt, or selects them if there are none yet."""
+    if not exists(f'{path}/spawn_points.txt'):
+        return make_origins()
+    with open(f'{path}/spawn_points.txt', 'r') as f:
+        return [int(line) for line in f if line.strip()]
+
+def make_input_arr(orig_nodes: list) -> list:
+    """Combines all origin nodes with all the other nodes as destinations."""
+    # Compile the list of destination nodes
+    dest_nodes = [x for x in G.nodes if x not in orig_nodes]
+    # Make the input array by combining all origin nodes with destination nodes
+    input_arr = []
+    for origin in orig_nodes:
+        for destination in dest_nodes:
+            input_arr.append([origin, destination])
+    return input_arr
         
 # Function that creates the route pickle
 def make_route_pickle(inp):
@@ -95,30 +146,14 @@ def make_route_pickle(inp):
     
     if dist > min_dist:
         # Create the path for these two nodes
-        route = nx.shortest_path(G, orig_node, dest_node)
-        # Extract the path geometry
-        geoms = [edges.loc[(u, v, 0), 'geometry'] for u, v in zip(route[:-1], route[1:])]
-        line = linemerge(geoms)
-        
-        # Prepare the edges is a very dumb way.
-        point_edges = []
-        i = 0
-        for geom, u, v in zip(geoms, route[:-1], route[1:]):
-            if i == 0:
-                # First edge, also take the first waypoint
-                for coord in geom.coords:
-                    point_edges.append([u,v])
-            else:
-                first = True
-                for coord in geom.coords:
-                    if first:
-                        first = False
-                        continue
-                    point_edges.append([u,v])
-            i += 1
+        route = router.shortest_path(orig_node, dest_node)
+        # Assemble the path geometry and the edge of every point from the packed edges
+        coords, point_edge, _ = route_geometry.assemble(route)
+        lats, lons = coords[:,1].tolist(), coords[:,0].tolist()
+        point_edges = route_geometry.edge_uv[point_edge].tolist()
         
         # Also prepare the turns
-        latlons = list(zip(line.xy[1], line.xy[0]))
+        latlons = list(zip(lats, lons))
         turns = [True] # Always make first wpt a turn
         i = 1
         for lat_cur, lon_cur in latlons[1:-1]:
@@ -145,7 +180,7 @@ def make_route_pickle(inp):
         #Last waypoint is always a turn one.        
         turns.append(True)
         # Pack everything up
-        route_pickle = list(zip(line.xy[1], line.xy[0], point_edges, turns))
+        route_pickle = list(zip(lats, lons, point_edges, turns))
 
     else:
         # Return to not create a pickle if path is too short.
@@ -155,31 +190,50 @@ def make_route_pickle(inp):
         pickle.dump(route_pickle, f)
     return route_pickle
 
+def make_orig_dest_dict() -> None:
+    """Saves which destinations have a route pickle for every origin, together with the
+    network distance matrix from these origins."""
+    orig_dest_dict = dict()
+    files_that_exist = os.listdir(f'{path}/pickles')
+    for filename in files_that_exist:
+        # If pkl not in file, skip
+        if 'pkl' not in filename:
+            continue
+        # First is origin, second is destination
+        split_filename = filename.replace('.pkl', '').split('-')
+        orig = int(split_filename[0])
+        dest = int(split_filename[1])
+        if orig not in orig_dest_dict:
+            orig_dest_dict[orig] = []
+            
+        orig_dest_dict[orig].append(dest)
+
+    # Save orig_nodes and dest_nodes to a file
+    with open(f'{path}/orig_dest_dict.pickle', 'wb') as f:
+        pickle.dump(orig_dest_dict, f)
+
+    # Also save the network distances from these origins, for the mission length filter
+    build_distance_matrix(G, list(orig_dest_dict.keys()), f'{path}/orig_dest_dist.npy')
+    return
+
+def make_routes() -> None:
+    """Makes the route pickles of all the origins, then the orig_dest_dict."""
+    if G is None:
+        load_graph()
+    input_arr = shard_items(make_input_arr(load_origins()), shard)
+    os.makedirs(f'{path}/pickles', exist_ok=True)
+    # The workers inherit the graph, or load it themselves, instead of getting it with every task
+    with Pool(num_cpu, initializer = init_worker, initargs = (path, routing_backend, min_dist)) as p:
+        _ = list(tqdm.tqdm(p.imap(make_route_pickle, input_arr, chunksize = 64), 
+                           total = len(input_arr)))
+    # With shards, the dict can only be made once all of them are done
+    if shard is None:
+        make_orig_dest_dict()
+    return
+
 def main():
-    print(f'Found {len(nodes_already_added)} spawn points.')
-    with Pool(8) as p:
-        _ = list(tqdm.tqdm(p.imap(make_route_pickle, input_arr), total = len(input_arr)))
-        p.close()
-    pass
+    make_origins()
+    make_routes()
     
 if __name__ == '__main__':
     main()
-
-orig_dest_dict = dict()
-files_that_exist = os.listdir(f'{path}/pickles')
-for filename in files_that_exist:
-    # If pkl not in file, skip
-    if 'pkl' not in filename:
-        continue
-    # First is origin, second is destination
-    split_filename = filename.replace('.pkl', '').split('-')
-    orig = int(split_filename[0])
-    dest = int(split_filename[1])
-    if orig not in orig_dest_dict:
-        orig_dest_dict[orig] = []
-        
-    orig_dest_dict[orig].append(dest)
-
-# Save orig_nodes and dest_nodes to a file
-with open(f'{path}/orig_dest_dict.pickle', 'wb') as f:
-    pickle.dump(orig_dest_dict, f)
@@ -0,0 +1,67 @@
+""" BlueSky plugin to call compressed scenario files.
+
+Copy this file to the plugins folder of BlueSky. PCALLZ takes the same arguments as
+PCALL, but the scenario file can be gzip (.scn.gz) or zstd (.scn.zst) compressed. The
+file is decompressed once into a cache folder in the scenario folder, and the
+decompressed copy is then called with PCALL. The cached copy is reused as long as it
+is newer than the compressed file.
+"""
+import gzip
+import os
+import shutil
+
+import bluesky as bs
+from bluesky import stack
+
+# Folder in the scenario folder where the decompressed files go
+CACHE_FOLDER = 'pcallz_cache'
+
+def init_plugin():
+    # Configuration parameters
+    config = {
+        # The name of your plugin
+        'plugin_name':     'M22COMPRESSEDSCN',
+
+        # The type of this plugin.
+        'plugin_type':     'sim'
+        }
+
+    return config
+
+@stack.command(name = 'PCALLZ')
+def pcallz(fname: 'string', *pcall_args: 'string'):
+    ''' PCALLZ filename [REL/ABS/args]: Call a (compressed) scenario file with PCALL. '''
+    scenario_path = bs.settings.scenario_path
+    path = fname if os.path.isabs(fname) else os.path.join(scenario_path, fname)
+    if not os.path.exists(path):
+        return False, f'PCALLZ: file {fname} not found.'
+
+    if path.endswith('.gz'):
+        opener = gzip.open
+    elif path.endswith('.zst'):
+        try:
+            import zstandard
+        except ImportError:
+            return False, 'PCALLZ: .zst files need the zstandard package.'
+        opener = lambda x: zstandard.ZstdDecompressor().stream_reader(open(x, 'rb'))
+    else:
+        # Not compressed, just call it
+        stack.stack(' '.join(['PCALL', fname] + list(pcall_args)))
+        return True
+
+    # Decompressed copy, in the same relative place in the cache folder
+    rel_path = os.path.splitext(os.path.relpath(os.path.abspath(path), os.path.abspath(scenario_path)))[0]
+    rel_path = rel_path.replace('..' + os.sep, '')
+    cache_path = os.path.join(CACHE_FOLDER, rel_path)
+    full_cache_path = os.path.join(scenario_path, cache_path)
+    if not os.path.exists(full_cache_path) or os.path.getmtime(full_cache_path) < os.path.getmtime(path):
+        os.makedirs(os.path.dirname(full_cache_path), exist_ok = True)
+        # Decompress next to the cached file and rename, such that a simulation running
+        # in parallel never calls a half written file.
+        tmp_path = f'{full_cache_path}.{os.getpid()}.tmp'
+        with opener(path) as f_in, open(tmp_path, 'wb') as f_out:
+            shutil.copyfileobj(f_in, f_out, 1 << 20)
+        os.replace(tmp_path, full_cache_path)
+
+    stack.stack(' '.join(['PCALL', cache_path] + list(pcall_args)))
+    return True
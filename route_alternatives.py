@@ -0,0 +1,218 @@
+import osmnx as ox
+import numpy as np
+from scipy.sparse.csgraph import dijkstra
+from multiprocessing import Pool
+import tqdm
+import os
+
+from routing import StreetGraphCSR
+from route_geometry import RouteGeometry
+from sharding import shard_items
+
+# The alternatives maker of a pool worker, set once by init_worker
+worker_maker = None
+
+def init_worker(maker):
+    """Pool initializer, gives the worker its own copy of the maker once, instead of
+    sending the maker and its graph along with every task."""
+    global worker_maker
+    worker_maker = maker
+    return
+
+def make_origin_alternatives_worker(args):
+    return worker_maker.make_origin_alternatives(*args)
+
+class RouteAlternativesMaker:
+    def __init__(self) -> None:
+        """Makes k diverse near-shortest routes for every flight of the intention files,
+        as input for the strategic solvers.
+
+        Two methods are available. 'plateau' combines the shortest path tree of the
+        origin with the reverse shortest path tree of the destination: every node v
+        gives the route origin -> v -> destination, and the cheapest of these that are
+        different enough from each other are kept. The tree of an origin is shared by
+        all flights that depart from it. 'penalty' repeatedly routes with the edges of
+        the already found routes made more expensive.
+        """
+        # City related parameters
+        self.city = 'Vienna' # City name
+        self.path = f'{self.city}' # Folder path
+        self.intention_path = self.path + '/Intentions/'
+        self.alternatives_path = self.path + '/Alternatives/'
+        self.G = ox.load_graphml(f'{self.path}/streets.graphml') # Load the street graph
+        self.graph = StreetGraphCSR(self.G, 'length')
+        self.reverse_matrix = self.graph.matrix.transpose().tocsr()
+        # Position of every edge in the matrix data, and its cost
+        coo = self.graph.matrix.tocoo()
+        self.edge_pos = {(u, v): k for k, (u, v) in enumerate(zip(coo.row.tolist(), coo.col.tolist()))}
+        self.edge_cost = dict(zip(self.edge_pos.keys(), coo.data.tolist()))
+        # Street numbers of the edges
+        self.route_geometry = RouteGeometry(self.G)
+        # Alternatives parameters
+        self.method = 'plateau' # 'plateau' or 'penalty'
+        self.num_alternatives = 3 # k, including the shortest route
+        self.max_stretch = 0.3 # alternatives are at most this much longer than the shortest
+        self.max_overlap = 0.7 # maximum fraction of length shared with a previous alternative
+        self.penalty = 0.5 # extra cost fraction of used edges in the penalty method
+        self.max_candidates = 500 # via nodes to try per flight in the plateau method
+        self.num_cpu = 2
+        # Sharding over multiple invocations, (i, N) or None for everything
+        self.shard = None
+        return
+
+    def make_all_alternatives(self) -> None:
+        """Makes the alternatives file of every intention file."""
+        os.makedirs(self.alternatives_path, exist_ok=True)
+        intention_files = sorted(x for x in os.listdir(self.intention_path) if x.endswith('.txt'))
+        for filename in shard_items(intention_files, self.shard):
+            self.make_alternatives_file(filename)
+        return
+
+    def make_alternatives_file(self, filename: str) -> None:
+        """Makes the alternatives of all flights of an intention file in one parallel pass.
+        The lines of the output file have the following format:
+        ACID;alternative number;length [m];nodes separated by ',';street number of each edge separated by ','
+        Flights whose destination cannot be reached have no lines.
+
+        Args:
+            filename (str): Name of the intention file in the intention folder.
+        """
+        with open(self.intention_path + filename, 'r') as f:
+            intention_lines = [line.replace('\n','').split(';') for line in f if line.strip()]
+        # Group the flights by origin, such that they share the shortest path tree
+        origin_groups = dict()
+        for i, intention in enumerate(intention_lines):
+            origin_groups.setdefault(int(intention[3]), []).append((i, intention[0], int(intention[4])))
+        tasks = list(origin_groups.items())
+        with Pool(self.num_cpu, initializer = init_worker, initargs = (self,)) as p:
+            results = list(tqdm.tqdm(p.imap(make_origin_alternatives_worker, tasks), total = len(tasks)))
+        # Put the flights back in the order of the intention file
+        flight_lines = [None] * len(intention_lines)
+        for result in results:
+            for i, lines in result:
+                flight_lines[i] = lines
+        with open(self.alternatives_path + filename.replace('.txt', '.alt'), 'w') as f:
+            f.write(''.join(''.join(lines) for lines in flight_lines))
+        return
+
+    def make_origin_alternatives(self, origin: int, flights: list) -> list:
+        """Makes the alternatives of all the flights that depart from one origin.
+
+        Args:
+            origin (int): The origin node.
+            flights (list): (index, acid, destination node) of each flight.
+
+        Returns:
+            list: (index, alternatives text) of each flight.
+        """
+        orig_idx = self.graph.node_idx[origin]
+        dest_idxs = [self.graph.node_idx[dest] for _, _, dest in flights]
+        if self.method == 'plateau':
+            # One forward tree for the origin, and the reverse trees of all destinations
+            # in one multi-source call.
+            fwd_dist, fwd_pred = dijkstra(self.graph.matrix, indices = orig_idx, return_predecessors = True)
+            unique_dests = list(dict.fromkeys(dest_idxs))
+            bwd_dist, bwd_pred = dijkstra(self.reverse_matrix, indices = unique_dests, return_predecessors = True)
+            dest_row = {dest: j for j, dest in enumerate(unique_dests)}
+        result = []
+        for (i, acid, _), dest_idx in zip(flights, dest_idxs):
+            if self.method == 'plateau':
+                j = dest_row[dest_idx]
+                routes = self.plateau_alternatives(orig_idx, dest_idx, fwd_dist, fwd_pred,
+                                                   bwd_dist[j], bwd_pred[j])
+            else:
+                routes = self.penalty_alternatives(orig_idx, dest_idx)
+            result.append((i, [self.get_alternative_line(acid, k, route) for k, route in enumerate(routes)]))
+        return result
+
+    def plateau_alternatives(self, orig_idx: int, dest_idx: int, fwd_dist: np.ndarray,
+                             fwd_pred: np.ndarray, bwd_dist: np.ndarray, bwd_pred: np.ndarray) -> list:
+        """Gives up to k routes through via nodes, as lists of node indices. No routes if the
+        destination cannot be reached."""
+        shortest = fwd_dist[dest_idx]
+        if not np.isfinite(shortest):
+            return []
+        via_cost = fwd_dist + bwd_dist
+        # Candidate via nodes, cheapest first. The nodes on the shortest route give the
+        # shortest route again, so only the destination is kept of those, as the first.
+        # The nodes on the same plateau give the same route, those are skipped as duplicates.
+        candidates = np.flatnonzero(via_cost <= (1 + self.max_stretch) * shortest)
+        candidates = candidates[~np.isin(candidates, self.tree_path(fwd_pred, orig_idx, dest_idx))]
+        candidates = candidates[np.argsort(via_cost[candidates], kind = 'stable')][:self.max_candidates]
+        candidates = np.concatenate([[dest_idx], candidates])
+        routes = []
+        route_edges = []
+        seen = set()
+        for via in candidates:
+            route = self.tree_path(fwd_pred, orig_idx, via)[:-1] + self.tree_path(bwd_pred, dest_idx, via)[::-1]
+            route_key = tuple(route)
+            if route_key in seen:
+                continue
+            seen.add(route_key)
+            # No loops
+            if len(set(route)) != len(route):
+                continue
+            edges = set(zip(route[:-1], route[1:]))
+            length = self.route_length(edges)
+            # Must be different enough from all the previous alternatives
+            if any(self.route_length(edges & other) > self.max_overlap * length for other in route_edges):
+                continue
+            routes.append(route)
+            route_edges.append(edges)
+            if len(routes) == self.num_alternatives:
+                break
+        return routes
+
+    def penalty_alternatives(self, orig_idx: int, dest_idx: int) -> list:
+        """Gives up to k routes by penalising the edges of the previous ones. No routes if the
+        destination cannot be reached."""
+        matrix = self.graph.matrix.copy()
+        routes = []
+        shortest = None
+        for _ in range(self.num_alternatives * 3):
+            dist, pred = dijkstra(matrix, indices = orig_idx, return_predecessors = True)
+            if not np.isfinite(dist[dest_idx]):
+                break
+            route = self.tree_path(pred, orig_idx, dest_idx)
+            edges = list(zip(route[:-1], route[1:]))
+            length = self.route_length(edges)
+            if shortest is None:
+                shortest = length
+            if length > (1 + self.max_stretch) * shortest:
+                break
+            if route not in routes:
+                routes.append(route)
+                if len(routes) == self.num_alternatives:
+                    break
+            # Make the used edges more expensive
+            matrix.data[[self.edge_pos[edge] for edge in edges]] *= 1 + self.penalty
+        return routes
+
+    def tree_path(self, predecessors: np.ndarray, root: int, node: int) -> list:
+        """Walks a shortest path tree from node back to its root, gives root -> node."""
+        path = [node]
+        while path[-1] != root:
+            if predecessors[path[-1]] < 0:
+                raise ValueError(f'No path between {self.graph.node_ids[root]} and {self.graph.node_ids[node]}.')
+            path.append(predecessors[path[-1]])
+        return path[::-1]
+
+    def route_length(self, edges) -> float:
+        return float(sum(self.edge_cost[edge] for edge in edges))
+
+    def get_alternative_line(self, acid: str, k: int, route: list) -> str:
+        nodes = self.graph.node_ids[route].tolist()
+        edges = self.route_geometry.route_edges(nodes)
+        length = self.route_length(zip(route[:-1], route[1:]))
+        streets = ','.join(str(x) for x in self.route_geometry.stroke[edges])
+        return f'{acid};{k};{length:.1f};{",".join(str(x) for x in nodes)};{streets}\n'
+
+
+def main():
+    maker = RouteAlternativesMaker()
+    # Make the alternatives of all intentions
+    maker.make_all_alternatives()
+    return
+
+if __name__ == "__main__":
+    main()
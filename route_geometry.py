@@ -0,0 +1,80 @@
+import numpy as np
+
+
+class RouteGeometry:
+    def __init__(self, G, decimals: int = 7) -> None:
+        """Packs the coordinates of all the edges of a street graph in one buffer, such
+        that the geometry of a route can be assembled by concatenating slices of it
+        instead of merging shapely lines for every flight.
+
+        Args:
+            G (nx.MultiDiGraph): The street graph.
+            decimals (int): Number of decimals to round the coordinates to. If None, the
+            coordinates are not rounded.
+        """
+        # Only the shortest edge between two nodes is used, which is the one the router takes
+        shortest = dict()
+        for u, v, data in G.edges(data=True):
+            if (u, v) not in shortest or data.get('length', 0) < shortest[(u, v)].get('length', 0):
+                shortest[(u, v)] = data
+        self.edge_idx = dict()
+        self.edge_uv = []
+        self.stroke = []
+        coord_list = []
+        counts = []
+        for (u, v), data in shortest.items():
+            self.edge_idx[(u, v)] = len(self.edge_uv)
+            self.edge_uv.append((u, v))
+            if 'stroke' not in data:
+                raise ValueError(f'Edge ({u}, {v}) has no stroke, the street graph needs the street numbers.')
+            self.stroke.append(data['stroke'])
+            # Edges without a geometry are straight lines between their nodes
+            if 'geometry' in data:
+                coords = np.asarray(data['geometry'].coords)[:, :2]
+            else:
+                coords = np.array([[G.nodes[u]['x'], G.nodes[u]['y']],
+                                   [G.nodes[v]['x'], G.nodes[v]['y']]])
+            coord_list.append(coords)
+            counts.append(len(coords))
+        # Packed lon/lat buffer, and where each edge starts in it
+        self.coords = np.concatenate(coord_list).astype(float)
+        if decimals is not None:
+            self.coords = np.round(self.coords, decimals)
+        self.offsets = np.zeros(len(counts) + 1, dtype=np.int64)
+        self.offsets[1:] = np.cumsum(counts)
+        self.edge_uv = np.array(self.edge_uv)
+        self.stroke = np.array(self.stroke, dtype=object)
+        return
+
+    def route_edges(self, route: list) -> np.ndarray:
+        """Gives the edge indices of a route given as a list of nodes."""
+        return np.array([self.edge_idx[(u, v)] for u, v in zip(route[:-1], route[1:])],
+                        dtype=np.int64)
+
+    def assemble(self, route: list) -> tuple:
+        """Assembles the geometry of a route. The first point of every edge except the
+        first one is dropped, as it is the last point of the previous edge.
+
+        Args:
+            route (list): The nodes of the route.
+
+        Returns:
+            tuple: (coords, point_edge, point_stroke), with coords an (N, 2) lon/lat array,
+            point_edge the edge index of each point and point_stroke its street number.
+        """
+        edges = self.route_edges(route)
+        starts = self.offsets[edges].copy()
+        ends = self.offsets[edges + 1]
+        # Skip the shared point for all but the first edge
+        starts[1:] += 1
+        counts = ends - starts
+        # Build the indices of all the points in the buffer in one go
+        point_edge = np.repeat(edges, counts)
+        first_point = np.cumsum(counts) - counts
+        point_idx = np.arange(counts.sum()) - np.repeat(first_point - starts, counts)
+        coords = self.coords[point_idx]
+        # Consecutive edges must connect, otherwise the route would not be a single line
+        if len(edges) > 1 and not np.array_equal(self.coords[self.offsets[edges[1:]]],
+                                                  self.coords[ends[:-1] - 1]):
+            raise ValueError(f'Route geometry is not contiguous between {route[0]} and {route[-1]}.')
+        return coords, point_edge, self.stroke[point_edge]
@@ -0,0 +1,452 @@
+import numpy as np
+import networkx as nx
+import heapq
+import hashlib
+import os
+from scipy.sparse import csr_matrix
+from scipy.sparse.csgraph import dijkstra
+
+
+def kwikdist(lata, lona, latb, lonb):
+    """Gives quick and dirty dist [m]
+    from lat/lon. (note: does not work well close to poles)"""
+
+    re      = 6371000.  # radius earth [m]
+    dlat    = np.radians(latb - lata)
+    dlon    = np.radians(((lonb - lona)+180)%360-180)
+    cavelat = np.cos(np.radians(lata + latb) * 0.5)
+
+    dangle  = np.sqrt(dlat * dlat + dlon * dlon * cavelat * cavelat)
+    dist    = re * dangle
+    return dist
+
+
+class StreetGraphCSR:
+    def __init__(self, G, weight: str = 'length') -> None:
+        """Compressed sparse row view of a street graph, so that routing can be done
+        on arrays instead of on the networkx dictionaries.
+
+        Args:
+            G (nx.MultiDiGraph): The street graph.
+            weight (str): Edge attribute to use as the edge cost. If None, every edge
+            costs 1, which is what nx.shortest_path does without a weight, but ties
+            between paths with as many edges are broken differently than networkx does.
+        """
+        self.weight = weight
+        # Map the osmnx node ids to array indices and back
+        self.node_ids = np.array(list(G.nodes))
+        self.node_idx = {node: i for i, node in enumerate(G.nodes)}
+        self.num_nodes = len(self.node_ids)
+        # Node coordinates, in the same order as the indices
+        self.lat = np.array([G.nodes[node]['y'] for node in G.nodes], dtype=float)
+        self.lon = np.array([G.nodes[node]['x'] for node in G.nodes], dtype=float)
+        # Get the cheapest edge between every pair of nodes. This is also what networkx
+        # does for multigraphs, and csr_matrix would otherwise sum the parallel edges.
+        costs = dict()
+        for u, v, data in G.edges(data=True):
+            cost = float(data[weight]) if weight is not None else 1.0
+            key = (self.node_idx[u], self.node_idx[v])
+            if key not in costs or cost < costs[key]:
+                costs[key] = cost
+        rows = np.array([key[0] for key in costs], dtype=np.int32)
+        cols = np.array([key[1] for key in costs], dtype=np.int32)
+        data = np.array(list(costs.values()), dtype=float)
+        self.matrix = csr_matrix((data, (rows, cols)), shape=(self.num_nodes, self.num_nodes))
+        return
+
+    def reconstruct_path(self, predecessors: np.ndarray, orig_idx: int, dest_idx: int) -> list:
+        """Walks a predecessor row back from the destination to the origin.
+
+        Args:
+            predecessors (np.ndarray): Predecessor row of a dijkstra run from orig_idx.
+            orig_idx (int): Index of the origin node.
+            dest_idx (int): Index of the destination node.
+
+        Returns:
+            list: The node ids of the path, origin first.
+        """
+        path = [dest_idx]
+        current = dest_idx
+        while current != orig_idx:
+            current = predecessors[current]
+            if current < 0:
+                raise nx.NetworkXNoPath(f'No path between {self.node_ids[orig_idx]} '
+                                        f'and {self.node_ids[dest_idx]}.')
+            path.append(current)
+        return self.node_ids[path[::-1]].tolist()
+
+
+class NetworkXRouter:
+    def __init__(self, G, weight: str = 'length') -> None:
+        """Routes directly on the networkx graph. This is the reference backend.
+
+        Args:
+            G (nx.MultiDiGraph): The street graph.
+            weight (str): Edge attribute to use as the edge cost.
+        """
+        self.G = G
+        self.weight = weight
+        return
+
+    def precompute(self, origins: list) -> None:
+        """Nothing to precompute for networkx, exists to keep the interface the same."""
+        return
+
+    def shortest_path(self, orig_node: int, dest_node: int) -> list:
+        return nx.shortest_path(self.G, orig_node, dest_node, weight=self.weight)
+
+    def shortest_paths(self, od_pairs: list) -> list:
+        return [self.shortest_path(orig, dest) for orig, dest in od_pairs]
+
+
+class ScipyRouter:
+    def __init__(self, G, weight: str = 'length', batch_size: int = 64) -> None:
+        """Routes on a CSR matrix of the street graph with scipy's dijkstra. Full
+        shortest path trees are computed per origin and cached, such that every flight
+        that departs from an already seen origin only costs a predecessor walk.
+
+        Args:
+            G (nx.MultiDiGraph): The street graph.
+            weight (str): Edge attribute to use as the edge cost.
+            batch_size (int): Number of origins per multi-source dijkstra call.
+        """
+        self.graph = StreetGraphCSR(G, weight)
+        self.batch_size = batch_size
+        # Predecessor and distance rows per origin index
+        self.predecessors = dict()
+        self.distances = dict()
+        return
+
+    def precompute(self, origins: list) -> None:
+        """Computes the shortest path trees of a set of origins in multi-source batches.
+
+        Args:
+            origins (list): Origin node ids.
+        """
+        origin_idxs = [self.graph.node_idx[node] for node in origins]
+        origin_idxs = [idx for idx in dict.fromkeys(origin_idxs) if idx not in self.predecessors]
+        for i in range(0, len(origin_idxs), self.batch_size):
+            batch = origin_idxs[i:i+self.batch_size]
+            dist, pred = dijkstra(self.graph.matrix, directed=True, indices=batch,
+                                  return_predecessors=True)
+            for j, idx in enumerate(batch):
+                self.distances[idx] = dist[j].astype(np.float32)
+                self.predecessors[idx] = pred[j].astype(np.int32)
+        return
+
+    def shortest_path(self, orig_node: int, dest_node: int) -> list:
+        orig_idx = self.graph.node_idx[orig_node]
+        if orig_idx not in self.predecessors:
+            self.precompute([orig_node])
+        return self.graph.reconstruct_path(self.predecessors[orig_idx], orig_idx,
+                                           self.graph.node_idx[dest_node])
+
+    def shortest_paths(self, od_pairs: list) -> list:
+        # Compute all the needed trees at once, then it's only predecessor walks
+        self.precompute([orig for orig, _ in od_pairs])
+        return [self.shortest_path(orig, dest) for orig, dest in od_pairs]
+
+    def distance(self, orig_node: int, dest_node: int) -> float:
+        orig_idx = self.graph.node_idx[orig_node]
+        if orig_idx not in self.distances:
+            self.precompute([orig_node])
+        return float(self.distances[orig_idx][self.graph.node_idx[dest_node]])
+
+
+class ALTRouter:
+    def __init__(self, G, weight: str = 'length', num_landmarks: int = 16, 
+                 landmark_path: str = None, bidirectional: bool = False) -> None:
+        """Point to point A* router with landmark (ALT) and kwikdist lower bounds. Meant
+        for single OD queries, where a full dijkstra would explore most of the city.
+
+        Args:
+            G (nx.MultiDiGraph): The street graph.
+            weight (str): Edge attribute to use as the edge cost.
+            num_landmarks (int): Number of landmarks to select if they need to be computed.
+            landmark_path (str): Path of the .npz file the landmark distances are stored in.
+            If it exists and was made for the same nodes, edges and edge costs it is loaded,
+            otherwise it is created or overwritten.
+            bidirectional (bool): Whether to search from both ends at the same time.
+        """
+        self.graph = StreetGraphCSR(G, weight)
+        self.bidirectional = bidirectional
+        # Adjacency in both directions
+        self.fwd = self.graph.matrix
+        self.bwd = self.graph.matrix.transpose().tocsr()
+        # The kwikdist is not exactly the length of an edge, so scale it down such that
+        # it never overestimates the length of any edge of this graph.
+        self.kwik_factor = self.get_kwik_factor()
+        # Get the landmark distances, stale ones would make the heuristic inadmissible
+        self.graph_hash = self.get_graph_hash()
+        if not (landmark_path is not None and os.path.exists(landmark_path) 
+                and self.load_landmarks(landmark_path)):
+            self.compute_landmarks(num_landmarks)
+            if landmark_path is not None:
+                self.save_landmarks(landmark_path)
+        # Number of nodes expanded by the last query
+        self.expanded = 0
+        return
+    
+    def get_kwik_factor(self) -> float:
+        coo = self.fwd.tocoo()
+        kwik = kwikdist(self.graph.lat[coo.row], self.graph.lon[coo.row], 
+                        self.graph.lat[coo.col], self.graph.lon[coo.col])
+        mask = kwik > 0
+        if not np.any(mask):
+            return 0.
+        # Small safety margin for the rounding of the lengths
+        return min(1., float(np.min(coo.data[mask] / kwik[mask]))) * (1 - 1e-6)
+    
+    def compute_landmarks(self, num_landmarks: int) -> None:
+        """Selects landmarks with the farthest point method, and computes the distances
+        from and to each of them."""
+        num_landmarks = min(num_landmarks, self.graph.num_nodes)
+        # Start from the node that is the farthest from the node closest to the centre
+        centre = np.argmin(kwikdist(self.graph.lat, self.graph.lon, 
+                                    np.mean(self.graph.lat), np.mean(self.graph.lon)))
+        landmarks = []
+        min_dist = dijkstra(self.fwd, indices=centre)
+        for _ in range(num_landmarks):
+            # Unreachable nodes are not good landmarks
+            candidate_dist = np.where(np.isfinite(min_dist), min_dist, -1)
+            landmark = int(np.argmax(candidate_dist))
+            landmarks.append(landmark)
+            min_dist = np.minimum(min_dist, dijkstra(self.fwd, indices=landmark))
+        self.landmarks = np.array(landmarks, dtype=np.int32)
+        # Distances from the landmarks to every node, and from every node to the landmarks
+        self.dist_from = dijkstra(self.fwd, indices=self.landmarks)
+        self.dist_to = dijkstra(self.bwd, indices=self.landmarks)
+        return
+    
+    def get_graph_hash(self) -> str:
+        """Hash of the node ids and the CSR structure and costs of the graph."""
+        h = hashlib.sha256()
+        for array in [self.graph.node_ids, self.fwd.indptr, self.fwd.indices, self.fwd.data]:
+            array = np.ascontiguousarray(array)
+            h.update(str(array.dtype).encode())
+            h.update(array.tobytes())
+        return h.hexdigest()
+    
+    def save_landmarks(self, landmark_path: str) -> None:
+        # Write next to the file and rename, such that readers never see half a file
+        tmp_path = f'{landmark_path}.{os.getpid()}.tmp'
+        with open(tmp_path, 'wb') as f:
+            np.savez_compressed(f, graph_hash=self.graph_hash, node_ids=self.graph.node_ids, 
+                                landmarks=self.landmarks, dist_from=self.dist_from, dist_to=self.dist_to)
+        os.replace(tmp_path, landmark_path)
+        return
+    
+    def load_landmarks(self, landmark_path: str) -> bool:
+        """Loads the landmarks if they were computed for this graph.
+
+        Returns:
+            bool: Whether they were loaded.
+        """
+        with np.load(landmark_path) as data:
+            if 'graph_hash' not in data or str(data['graph_hash']) != self.graph_hash:
+                print(f'Landmarks in {landmark_path} were computed for another graph, recomputing them.')
+                return False
+            self.landmarks = data['landmarks']
+            self.dist_from = data['dist_from']
+            self.dist_to = data['dist_to']
+        return True
+    
+    def lower_bound(self, node_idx: int, target_idx: int, reverse: bool = False) -> float:
+        """Lower bound of the distance from node to target, or from target to node if
+        reverse is True."""
+        if reverse:
+            # The target is actually the source
+            node_idx, target_idx = target_idx, node_idx
+        bound = self.kwik_factor * kwikdist(self.graph.lat[node_idx], self.graph.lon[node_idx],
+                                            self.graph.lat[target_idx], self.graph.lon[target_idx])
+        # Triangle inequality with the landmarks, in both directions
+        lm_from = self.dist_from[:, target_idx] - self.dist_from[:, node_idx]
+        lm_to = self.dist_to[:, node_idx] - self.dist_to[:, target_idx]
+        lm_bound = np.max(np.maximum(lm_from, lm_to))
+        if np.isfinite(lm_bound) and lm_bound > bound:
+            bound = lm_bound
+        return float(bound)
+
+    def precompute(self, origins: list) -> None:
+        """Point to point router, nothing to precompute per origin."""
+        return
+
+    def shortest_path(self, orig_node: int, dest_node: int) -> list:
+        orig_idx = self.graph.node_idx[orig_node]
+        dest_idx = self.graph.node_idx[dest_node]
+        if orig_idx == dest_idx:
+            self.expanded = 0
+            return [orig_node]
+        if self.bidirectional:
+            path = self.bidirectional_search(orig_idx, dest_idx)
+        else:
+            path = self.astar_search(orig_idx, dest_idx)
+        return self.graph.node_ids[path].tolist()
+
+    def shortest_paths(self, od_pairs: list) -> list:
+        return [self.shortest_path(orig, dest) for orig, dest in od_pairs]
+    
+    def astar_search(self, orig_idx: int, dest_idx: int) -> list:
+        indptr, indices, costs = self.fwd.indptr, self.fwd.indices, self.fwd.data
+        dist = {orig_idx: 0.}
+        pred = {orig_idx: -1}
+        closed = set()
+        heap = [(self.lower_bound(orig_idx, dest_idx), orig_idx)]
+        while heap:
+            _, node = heapq.heappop(heap)
+            if node in closed:
+                continue
+            closed.add(node)
+            if node == dest_idx:
+                break
+            for j in range(indptr[node], indptr[node+1]):
+                nxt = indices[j]
+                new_dist = dist[node] + costs[j]
+                if new_dist < dist.get(nxt, np.inf):
+                    dist[nxt] = new_dist
+                    pred[nxt] = node
+                    # Reopen if needed, the kwikdist bound is only nearly consistent
+                    closed.discard(nxt)
+                    heapq.heappush(heap, (new_dist + self.lower_bound(nxt, dest_idx), nxt))
+        self.expanded = len(closed)
+        if dest_idx not in pred:
+            raise nx.NetworkXNoPath(f'No path between {self.graph.node_ids[orig_idx]} '
+                                    f'and {self.graph.node_ids[dest_idx]}.')
+        path = [dest_idx]
+        while pred[path[-1]] != -1:
+            path.append(pred[path[-1]])
+        return path[::-1]
+    
+    def bidirectional_search(self, orig_idx: int, dest_idx: int) -> list:
+        # Average potential, such that the forward and backward reduced costs are the same
+        potentials = dict()
+        def potential(node):
+            if node not in potentials:
+                potentials[node] = 0.5 * (self.lower_bound(node, dest_idx) 
+                                          - self.lower_bound(node, orig_idx, reverse = True))
+            return potentials[node]
+        # Per direction: adjacency, distances, predecessors, closed set, heap, potential sign
+        searches = []
+        for adjacency, start, sign in [(self.fwd, orig_idx, 1), (self.bwd, dest_idx, -1)]:
+            searches.append({'adj': adjacency, 'dist': {start: 0.}, 'pred': {start: -1},
+                             'closed': set(), 'heap': [(sign * potential(start), start)],
+                             'sign': sign})
+        best = np.inf
+        meeting = -1
+        while searches[0]['heap'] and searches[1]['heap']:
+            # Stop when no shorter path can be found anymore
+            if searches[0]['heap'][0][0] + searches[1]['heap'][0][0] >= best:
+                break
+            # Expand the direction with the smallest queue
+            search, other = (searches[0], searches[1]) if len(searches[0]['heap']) <= \
+                                len(searches[1]['heap']) else (searches[1], searches[0])
+            _, node = heapq.heappop(search['heap'])
+            if node in search['closed']:
+                continue
+            search['closed'].add(node)
+            adj = search['adj']
+            for j in range(adj.indptr[node], adj.indptr[node+1]):
+                nxt = adj.indices[j]
+                new_dist = search['dist'][node] + adj.data[j]
+                if new_dist < search['dist'].get(nxt, np.inf):
+                    search['dist'][nxt] = new_dist
+                    search['pred'][nxt] = node
+                    search['closed'].discard(nxt)
+                    heapq.heappush(search['heap'], (new_dist + search['sign'] * potential(nxt), nxt))
+                    # Check whether the two searches meet here
+                    if nxt in other['dist'] and new_dist + other['dist'][nxt] < best:
+                        best = new_dist + other['dist'][nxt]
+                        meeting = nxt
+        self.expanded = len(searches[0]['closed']) + len(searches[1]['closed'])
+        if meeting == -1:
+            raise nx.NetworkXNoPath(f'No path between {self.graph.node_ids[orig_idx]} '
+                                    f'and {self.graph.node_ids[dest_idx]}.')
+        # Stitch the two halves together at the meeting node
+        path = [meeting]
+        while searches[0]['pred'][path[-1]] != -1:
+            path.append(searches[0]['pred'][path[-1]])
+        path = path[::-1]
+        while searches[1]['pred'][path[-1]] != -1:
+            path.append(searches[1]['pred'][path[-1]])
+        return path
+
+
+class NetworkDistanceMatrix:
+    def __init__(self, matrix_path: str) -> None:
+        """Memory-mapped origin x node network distance matrix, made with
+        build_distance_matrix. Looking up a distance is a single array access.
+
+        Args:
+            matrix_path (str): Path of the .npy matrix. The origin and node ids are in
+            the .npz file with the same name.
+        """
+        self.matrix_path = matrix_path
+        self.matrix = np.load(matrix_path, mmap_mode='r')
+        index = np.load(matrix_path.replace('.npy', '.npz'))
+        self.origins = index['origins'].tolist()
+        self.origin_row = {node: i for i, node in enumerate(self.origins)}
+        self.node_col = {node: i for i, node in enumerate(index['node_ids'].tolist())}
+        return
+
+    def __getstate__(self):
+        # Pool workers map the file again instead of getting a copy of the whole matrix
+        state = self.__dict__.copy()
+        state.pop('matrix')
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.matrix = np.load(self.matrix_path, mmap_mode='r')
+
+    def distance(self, orig_node: int, dest_node: int) -> float:
+        return float(self.matrix[self.origin_row[orig_node], self.node_col[dest_node]])
+
+
+def build_distance_matrix(G, origins: list, matrix_path: str, weight: str = 'length', 
+                          batch_size: int = 64) -> None:
+    """Computes the network distance from every origin to every node of the graph and
+    saves it as a float32 .npy file that can be memory mapped. Unreachable nodes get inf.
+
+    Args:
+        G (nx.MultiDiGraph): The street graph.
+        origins (list): Origin node ids, one row each.
+        matrix_path (str): Path of the .npy file to write.
+        weight (str): Edge attribute to use as the edge cost.
+        batch_size (int): Number of origins per multi-source dijkstra call.
+    """
+    graph = StreetGraphCSR(G, weight)
+    origin_idxs = [graph.node_idx[node] for node in origins]
+    matrix = np.lib.format.open_memmap(matrix_path, mode='w+', dtype=np.float32, 
+                                       shape=(len(origins), graph.num_nodes))
+    # Fill it in batches to not have the whole float64 result in memory
+    for i in range(0, len(origin_idxs), batch_size):
+        matrix[i:i+batch_size] = dijkstra(graph.matrix, directed=True, 
+                                          indices=origin_idxs[i:i+batch_size])
+    matrix.flush()
+    del matrix
+    np.savez(matrix_path.replace('.npy', '.npz'), origins=np.array(origins), node_ids=graph.node_ids)
+    return
+
+
+def make_router(G, backend: str = 'networkx', weight: str = 'length', landmark_path: str = None):
+    """Creates the routing backend with the given name.
+
+    Args:
+        G (nx.MultiDiGraph): The street graph.
+        backend (str): 'networkx', 'scipy', 'alt' or 'bialt'.
+        weight (str): Edge attribute to use as the edge cost.
+        landmark_path (str): Where the landmark distances of the ALT backends are stored.
+
+    Returns:
+        A router with a shortest_path(orig_node, dest_node) method.
+    """
+    if backend == 'networkx':
+        return NetworkXRouter(G, weight)
+    elif backend == 'scipy':
+        return ScipyRouter(G, weight)
+    elif backend == 'alt':
+        return ALTRouter(G, weight, landmark_path = landmark_path)
+    elif backend == 'bialt':
+        return ALTRouter(G, weight, landmark_path = landmark_path, bidirectional = True)
+    else:
+        raise ValueError(f'Routing backend {backend} is not implemented.')
@@ -1,22 +1,59 @@
-import shutil
-from multiprocessing import Pool
 import itertools
-import tqdm
+import csv
+import io
 import os
 import re
 
+from sharding import in_shard
+from async_writer import get_writer, COMPRESSION_SUFFIX
+
+# The parameters of an experiment, in the order create_scenario_file takes them
+PARAMETERS = ['demand', 'tactical', 'strategic', 'delay_mag', 'delay_prob', 'wind_mag', 'wind_dir', 'repetition']
+
+# The columns of the manifest
+MANIFEST_COLUMNS = ['filename'] + PARAMETERS + ['base_scenario', 'num_flights', 'base_size', 'base_size_predicted']
+
+def read_manifest(path: str) -> list:
+    """Reads the manifest of the experiment files in a folder.
+
+    Returns:
+        list: A dict per experiment file, in the order they were made. None if there is
+        no manifest.
+    """
+    manifest_path = os.path.join(path, 'manifest.csv')
+    if not os.path.exists(manifest_path):
+        return None
+    with open(manifest_path, 'r', newline='') as f:
+        return list(csv.DictReader(f))
+
 class ScenarioMaker:
     def __init__(self) -> None:
         # City related parameters
         self.city = 'Vienna' # City name
         self.path = f'{self.city}' # Folder path
         self.scenario_path = self.path + '/Base_Scenarios/'
+        self.intention_path = self.path + '/Intentions/'
         self.output_path = self.path + '/M2.2/'
         # Aircraft related 
         self.speed = 30
         self.layer_height = 50 #ft
         self.max_altitude = 500
-        self.num_cpu = 32
+        # Length of the intentions, the same as in IntentionMaker, to predict the number of
+        # flights of the base scenarios whose intention file is not made yet
+        self.intention_timespan = 90 # minutes
+        # Size of a flight in an uncompressed base scenario, to predict the size of the base
+        # scenarios that are not made yet if there are none in the same folder to measure
+        self.bytes_per_flight = 1800
+        # Size of the compressed base scenarios relative to uncompressed ones
+        self.compression_ratio = {None: 1, 'gzip': 0.2, 'zstd': 0.2}
+        # The number of flights and bytes per flight that were found, by file and folder
+        self.num_flights = dict()
+        self.folder_bytes_per_flight = dict()
+        # Sharding over multiple invocations, (i, N) or None for everything
+        self.shard = None
+        # Compression of the base scenarios, None, 'gzip' or 'zstd'. Compressed ones are
+        # called with PCALLZ of the m22_compressed_scn plugin.
+        self.compression = None
         # Independent variables
         self.demand = [120, 180, 240]
         self.tactical = ['NoCR', 'SB']
@@ -26,49 +63,64 @@ class ScenarioMaker:
         self.wind_mag = [2, 4, 6, 8]
         self.wind_dir = [0, 90, 180, 270]
         self.repetition = [1,2,3,4,5]
+        # The experiment matrix, a list of sweeps. Every sweep gives the values of each
+        # parameter, and all their combinations are experiments.
+        self.experiment_matrix = [
+            # First with 0 wind and delay
+            {'demand': self.demand, 'tactical': self.tactical, 'strategic': self.strategic,
+             'delay_mag': [0], 'delay_prob': [0], 'wind_mag': [0], 'wind_dir': [0],
+             'repetition': self.repetition},
+            # Now fix the demand and do the delay with 0 wind
+            {'demand': [self.demand[1]], 'tactical': self.tactical, 'strategic': self.strategic,
+             'delay_mag': self.delay_mag, 'delay_prob': self.delay_prob, 'wind_mag': [0], 'wind_dir': [0],
+             'repetition': self.repetition},
+            # And now the wind
+            {'demand': [self.demand[1]], 'tactical': self.tactical, 'strategic': self.strategic,
+             'delay_mag': [0], 'delay_prob': [0], 'wind_mag': self.wind_mag, 'wind_dir': self.wind_dir,
+             'repetition': self.repetition}]
         return
     
+    def get_experiments(self):
+        """Gives the experiments of the matrix one by one, each combination only once, in the
+        order of the sweeps.
+
+        Yields:
+            tuple: The values of the PARAMETERS.
+        """
+        seen = set()
+        for sweep in self.experiment_matrix:
+            for args in itertools.product(*[sweep[parameter] for parameter in PARAMETERS]):
+                if args not in seen:
+                    seen.add(args)
+                    yield args
+    
     def create_experiment_scenarios(self):
-        # First list is with 0 wind and delay
-        input_arr_1 = list(itertools.product(*[self.demand, 
-                                       self.tactical, 
-                                       self.strategic, 
-                                       [0], 
-                                       [0], 
-                                       [0], 
-                                       [0], 
-                                       self.repetition]))
-        
-        # Now fix the demand and do the delay with 0 wind
-        input_arr_2 = list(itertools.product(*[[self.demand[1]], 
-                                       self.tactical, 
-                                       self.strategic, 
-                                       self.delay_mag, 
-                                       self.delay_prob, 
-                                       [0], 
-                                       [0], 
-                                       self.repetition]))
-        
-        # And now the delay
-        input_arr_3 = list(itertools.product(*[[self.demand[1]], 
-                                       self.tactical, 
-                                       self.strategic, 
-                                       [0], 
-                                       [0], 
-                                       self.wind_mag, 
-                                       self.wind_dir, 
-                                       self.repetition]))
-        
-        input_arr = input_arr_1 + input_arr_2 + input_arr_3
-        
-        # Make a pool and create scenarios
-        with Pool(self.num_cpu) as p:
-            _ = list(tqdm.tqdm(p.imap(self.create_scenario_file, input_arr), total = len(input_arr)))
-        
-        
-    def create_scenario_file(self, args):
-        # Unpack
-        demand, tactical, strategic, delay_mag, delay_prob, wind_mag, wind_dir, repetition = args
+        """Writes the experiment files of this shard, and the manifest of all experiments.
+        Only the first shard writes the manifest. The files are tiny, so they are all written
+        in one pass through the background writer."""
+        os.makedirs(self.output_path, exist_ok=True)
+        manifest = []
+        for i, args in enumerate(self.get_experiments()):
+            base_scen = self.get_base_scenario(args)
+            if base_scen is None:
+                continue
+            if in_shard(i, self.shard):
+                self.create_scenario_file(args)
+            manifest.append(self.get_manifest_row(args, base_scen))
+        # The manifest describes all the experiments, so one shard is enough to write it
+        if self.shard is None or self.shard[0] == 0:
+            text = io.StringIO()
+            writer = csv.DictWriter(text, MANIFEST_COLUMNS, lineterminator='\n')
+            writer.writeheader()
+            writer.writerows(manifest)
+            with get_writer().open(self.output_path + 'manifest.csv') as f:
+                f.write(text.getvalue())
+        get_writer().flush()
+        return manifest
+    
+    def get_base_scenario(self, args) -> str:
+        """Gives the base scenario of an experiment, relative to the base scenario folder."""
+        demand, _, strategic, _, _, _, _, repetition = args
         # If strategic is Random Alt, we load a standard scenario
         if strategic == 'RALT':
             base_scen = f'Standard/Flight_intention_{demand}_{repetition}.scn'
@@ -81,6 +133,68 @@ class ScenarioMaker:
         else:
             # weird
             print(f'Strategic {strategic} is not implemented.')
+            return None
+        return base_scen + COMPRESSION_SUFFIX[self.compression]
+    
+    def get_experiment_name(self, args) -> str:
+        demand, tactical, strategic, delay_mag, delay_prob, wind_mag, wind_dir, repetition = args
+        return f'M22_{demand}_{tactical}_{strategic}_{delay_mag}_{delay_prob}_{wind_dir}_{wind_mag}_{repetition}.scn'
+    
+    def get_manifest_row(self, args, base_scen: str) -> dict:
+        """Gives the manifest entry of an experiment. The size is that of the base scenario
+        if it was made already, and otherwise predicted from the number of flights."""
+        demand, repetition = args[0], args[-1]
+        row = dict(zip(PARAMETERS, args))
+        row['filename'] = self.get_experiment_name(args)
+        row['base_scenario'] = base_scen
+        row['num_flights'] = self.get_num_flights(demand, repetition)
+        base_path = self.scenario_path + base_scen
+        if os.path.exists(base_path):
+            row['base_size'] = os.path.getsize(base_path)
+            row['base_size_predicted'] = 0
+        else:
+            folder = os.path.dirname(base_path)
+            row['base_size'] = round(row['num_flights'] * self.get_bytes_per_flight(folder))
+            row['base_size_predicted'] = 1
+        return row
+    
+    def get_num_flights(self, demand: int, repetition: int) -> int:
+        """Gives the number of flights of an intention file, or predicts it from the demand
+        and the intention timespan if the file is not made yet."""
+        if (demand, repetition) not in self.num_flights:
+            filename = self.intention_path + f'Flight_intention_{demand}_{repetition}.txt'
+            if os.path.exists(filename):
+                with open(filename, 'r') as f:
+                    self.num_flights[(demand, repetition)] = sum(1 for line in f if line.strip())
+            else:
+                self.num_flights[(demand, repetition)] = demand * self.intention_timespan
+        return self.num_flights[(demand, repetition)]
+    
+    def get_bytes_per_flight(self, folder: str) -> float:
+        """Gives the average size of a flight in the base scenarios of a folder that are made
+        already, or the default size if there are none."""
+        if folder not in self.folder_bytes_per_flight:
+            size = 0
+            num_flights = 0
+            suffix = '.scn' + COMPRESSION_SUFFIX[self.compression]
+            if os.path.isdir(folder):
+                for filename in os.listdir(folder):
+                    match = re.fullmatch(r'Flight_intention_(\d+)_(\d+)' + re.escape(suffix), filename)
+                    if match is None:
+                        continue
+                    size += os.path.getsize(os.path.join(folder, filename))
+                    num_flights += self.get_num_flights(int(match[1]), int(match[2]))
+            if num_flights > 0:
+                self.folder_bytes_per_flight[folder] = size / num_flights
+            else:
+                self.folder_bytes_per_flight[folder] = self.bytes_per_flight * self.compression_ratio[self.compression]
+        return self.folder_bytes_per_flight[folder]
+        
+    def create_scenario_file(self, args):
+        # Unpack
+        demand, tactical, strategic, delay_mag, delay_prob, wind_mag, wind_dir, repetition = args
+        base_scen = self.get_base_scenario(args)
+        if base_scen is None:
             return False
             
         # We build the starting commands in function of the options
@@ -102,7 +216,11 @@ class ScenarioMaker:
             scen_text += '00:00:00>ENABLESPAWNPROTECTION\n'
         scen_text += '00:00:00>SCHEDULE 02:00:00 DELETEALL\n'
         scen_text += '00:00:00>SCHEDULE 02:00:01 HOLD\n'
-        scen_text += f'00:00:00>PCALL M2.2/Base_Scenarios/{base_scen}\n'
+        if self.compression is None:
+            scen_text += f'00:00:00>PCALL M2.2/Base_Scenarios/{base_scen}\n'
+        else:
+            scen_text += '00:00:00>PLUGINS LOAD M22COMPRESSEDSCN\n'
+            scen_text += f'00:00:00>PCALLZ M2.2/Base_Scenarios/{base_scen}\n'
         scen_text += '00:00:00.00>FF\n\n'
         
         # Open base scen
@@ -110,8 +228,8 @@ class ScenarioMaker:
             #base_scen_text = f.read()
             
         # Open final scenario file
-        out_scen_name = f'M22_{demand}_{tactical}_{strategic}_{delay_mag}_{delay_prob}_{wind_dir}_{wind_mag}_{repetition}.scn'
-        with open(self.output_path + out_scen_name, 'w') as f:
+        out_scen_name = self.get_experiment_name(args)
+        with get_writer().open(self.output_path + out_scen_name) as f:
             f.write(scen_text)
             #f.write(base_scen_text)
         return True
@@ -0,0 +1,260 @@
+import osmnx as ox
+import numpy as np
+from multiprocessing import Pool
+import tqdm
+import os
+
+from scn_format import parse_cre_line, hhmmss_to_seconds
+from async_writer import open_compressed
+
+# The validator of a pool worker, set once by init_worker
+worker_validator = None
+
+def init_worker(validator):
+    """Pool initializer, gives the worker its own copy of the validator once, instead of
+    sending the validator and its lookup tables along with every task."""
+    global worker_validator
+    worker_validator = validator
+    return
+
+def validate_file_worker(filename):
+    return worker_validator.validate_file(filename)
+
+# Extensions of the (compressed) scenario files
+SCENARIO_EXTENSIONS = ('.scn', '.scn.gz', '.scn.zst')
+
+class ScenarioValidator:
+    def __init__(self) -> None:
+        """Checks the generated intention, base scenario and experiment files, such that
+        broken files are found before they are simulated. Every M22CRE line is checked
+        against the street graph: all the legs between waypoints must be segments of the
+        edge geometries or whole edges, the turn flags must match the turn angles, the
+        altitude must be a layer and every waypoint must have a street number. The spawn
+        times and RTAs must not decrease, and PCALL targets must exist."""
+        # City related parameters
+        self.city = 'Vienna' # City name
+        self.path = f'{self.city}' # Folder path
+        self.intention_path = self.path + '/Intentions/'
+        self.scenario_path = self.path + '/Base_Scenarios/'
+        self.experiment_path = self.path + '/M2.2/'
+        self.G = ox.load_graphml(f'{self.path}/streets.graphml') # Load the street graph
+        # Aircraft related
+        self.layer_height = 50 #ft
+        self.max_altitude = 500
+        # Check parameters
+        self.latlon_decimals = 7 # decimals of the coordinates in the scenario files
+        self.turn_angle = 25 # degrees, above which a waypoint is a turn
+        self.turn_tolerance = 0.5 # degrees around the turn angle in which both flags are fine
+        self.num_cpu = 4
+        self.nodes = set(self.G.nodes)
+        self.make_lookup_tables()
+        return
+
+    def __getstate__(self):
+        # The pool workers only need the lookup tables, not the graph
+        state = self.__dict__.copy()
+        state.pop('G', None)
+        return state
+
+    def make_lookup_tables(self) -> None:
+        """Makes the sorted keys of all the points of the street graph, and of all the legs
+        that a route can have: every segment of an edge geometry, and the straight line
+        between the nodes of every edge, which the strategic scenarios use."""
+        points_a = []
+        points_b = []
+        for u, v, data in self.G.edges(data=True):
+            node_coords = np.array([[self.G.nodes[u]['x'], self.G.nodes[u]['y']],
+                                    [self.G.nodes[v]['x'], self.G.nodes[v]['y']]])
+            if 'geometry' in data:
+                coords = np.asarray(data['geometry'].coords)[:, :2]
+            else:
+                coords = node_coords
+            points_a += [coords[:-1], node_coords[:1]]
+            points_b += [coords[1:], node_coords[1:]]
+        key_a = self.point_keys(np.concatenate(points_a))
+        key_b = self.point_keys(np.concatenate(points_b))
+        self.point_key = np.unique(np.concatenate([key_a, key_b]))
+        self.leg_key = np.unique(np.searchsorted(self.point_key, key_a) * len(self.point_key)
+                                 + np.searchsorted(self.point_key, key_b))
+        return
+
+    def point_keys(self, lonlat: np.ndarray) -> np.ndarray:
+        """Packs lon/lat coordinates, rounded like in the scenario files, in one integer."""
+        q = np.round(np.asarray(lonlat, dtype = float) * 10**self.latlon_decimals).astype(np.int64)
+        # Offset to non-negative 32 bit values, and pack them unsigned such that it cannot overflow
+        q = (q + (1 << 31)).astype(np.uint64)
+        return (q[:, 0] << np.uint64(32)) | q[:, 1]
+
+    def validate_all(self) -> dict:
+        """Validates all the intention, base scenario and experiment files, in parallel.
+
+        Returns:
+            dict: The report of every file, by path.
+        """
+        filenames = []
+        if os.path.isdir(self.intention_path):
+            filenames += [self.intention_path + x for x in sorted(os.listdir(self.intention_path)) if x.endswith('.txt')]
+        if os.path.isdir(self.scenario_path):
+            for folder in sorted(os.listdir(self.scenario_path)):
+                folder_path = self.scenario_path + folder + '/'
+                if os.path.isdir(folder_path):
+                    filenames += [folder_path + x for x in sorted(os.listdir(folder_path)) if x.endswith(SCENARIO_EXTENSIONS)]
+        if os.path.isdir(self.experiment_path):
+            filenames += [self.experiment_path + x for x in sorted(os.listdir(self.experiment_path)) if x.endswith('.scn')]
+        # Big files first, such that the processes finish at about the same time
+        filenames.sort(key = os.path.getsize, reverse = True)
+        with Pool(self.num_cpu, initializer = init_worker, initargs = (self,)) as p:
+            reports = list(tqdm.tqdm(p.imap(validate_file_worker, filenames), total = len(filenames)))
+        reports = dict(sorted(zip(filenames, reports)))
+        for filename, report in reports.items():
+            errors = {key: value for key, value in report.items() if key != 'num_flights' and value}
+            if errors:
+                print(f'{filename}: {report["num_flights"]} flights, {errors}')
+        num_bad = sum(any(value for key, value in report.items() if key != 'num_flights')
+                      for report in reports.values())
+        print(f'{len(reports)} files checked, {num_bad} with errors.')
+        return reports
+
+    def validate_file(self, filename: str) -> dict:
+        """Validates one file, an intention file if it ends with .txt, and otherwise a
+        scenario file with M22CRE lines, PCALL commands, or both."""
+        if filename.endswith('.txt'):
+            return self.validate_intention(filename)
+        with open_compressed(filename, 'rt') as f:
+            lines = f.readlines()
+        report = {'num_flights': 0, 'parse_errors': 0, 'missing_pcall': []}
+        flights = []
+        for line in lines:
+            command = line.strip().partition('>')[2]
+            if command.startswith('PCALL ') or command.startswith('PCALLZ '):
+                target = command.split()[1]
+                if self.resolve_pcall(target) is None:
+                    report['missing_pcall'].append(target)
+            elif command.startswith('M22CRE '):
+                try:
+                    flights.append(parse_cre_line(line))
+                except ValueError:
+                    report['parse_errors'] += 1
+        report.update(self.validate_flights(flights))
+        return report
+
+    def resolve_pcall(self, target: str) -> str:
+        """Finds the file of a PCALL target. BlueSky gets the city folder and its experiment
+        folder as scenario/M2.2, so the target can be in either of them."""
+        rel_path = target.split('/', 1)[1] if target.startswith('M2.2/') else target
+        for folder in [self.path, self.experiment_path]:
+            path = os.path.join(folder, rel_path)
+            if os.path.exists(path):
+                return path
+        return None
+
+    def validate_flights(self, flights: list) -> dict:
+        """Checks parsed M22CRE lines, all flights at once.
+
+        Returns:
+            dict: The number of flights, and of each kind of error.
+        """
+        report = {'num_flights': len(flights), 'short_routes': 0, 'duplicate_acids': 0,
+                  'unordered_times': 0, 'bad_altitudes': 0, 'missing_streets': 0,
+                  'unknown_waypoints': 0, 'unknown_legs': 0, 'wrong_turns': 0, 'unordered_rtas': 0}
+        if not flights:
+            return report
+        acids = [flight['acid'] for flight in flights]
+        report['duplicate_acids'] = len(acids) - len(set(acids))
+        times = np.array([flight['time'] for flight in flights])
+        report['unordered_times'] = int(np.sum(np.diff(times) < 0))
+        alts = np.array([flight['alt'] for flight in flights])
+        report['bad_altitudes'] = int(np.sum((alts % self.layer_height != 0) | (alts <= 0)
+                                             | (alts >= self.max_altitude)))
+        num_wpts = np.array([len(flight['lats']) for flight in flights])
+        report['short_routes'] = int(np.sum(num_wpts < 2))
+        # All the waypoints of all the flights
+        lats = np.concatenate([flight['lats'] for flight in flights])
+        lons = np.concatenate([flight['lons'] for flight in flights])
+        turns = np.concatenate([flight['turns'] for flight in flights])
+        streets = np.concatenate([flight['streets'] for flight in flights])
+        report['missing_streets'] = int(np.sum(streets == ''))
+        # Every waypoint must be a point of the street graph
+        keys = self.point_keys(np.column_stack([lons, lats]))
+        point_idx = np.clip(np.searchsorted(self.point_key, keys), 0, len(self.point_key) - 1)
+        known = self.point_key[point_idx] == keys
+        report['unknown_waypoints'] = int(np.sum(~known))
+        # Legs within a flight, so not from the last waypoint of a flight to the next flight
+        last_wpt = np.cumsum(num_wpts) - 1
+        is_leg = np.ones(len(lats) - 1, dtype = bool)
+        is_leg[last_wpt[:-1]] = False
+        leg_keys = point_idx[:-1] * len(self.point_key) + point_idx[1:]
+        leg_idx = np.clip(np.searchsorted(self.leg_key, leg_keys), 0, len(self.leg_key) - 1)
+        leg_known = (self.leg_key[leg_idx] == leg_keys) & known[:-1] & known[1:]
+        report['unknown_legs'] = int(np.sum(is_leg & ~leg_known))
+        # The turn flags of the waypoints between two legs of the same flight
+        qdr = self.kwikqdr(lats[:-1], lons[:-1], lats[1:], lons[1:])
+        angle = np.abs(qdr[1:] - qdr[:-1])
+        angle = np.where(angle > 180, 360 - angle, angle)
+        is_turn_wpt = is_leg[:-1] & is_leg[1:]
+        ambiguous = np.abs(angle - self.turn_angle) < self.turn_tolerance
+        wrong = is_turn_wpt & ~ambiguous & ((angle > self.turn_angle) != turns[1:-1])
+        # The last waypoint of a flight is always a turn
+        report['wrong_turns'] = int(np.sum(wrong) + np.sum(~turns[last_wpt]))
+        # The RTAs that are given must not decrease along the route
+        for flight in flights:
+            rtas = [hhmmss_to_seconds(rta) for rta in flight['rtas'] if rta]
+            if np.any(np.diff(rtas) < 0):
+                report['unordered_rtas'] += 1
+        return report
+
+    def validate_intention(self, filename: str) -> dict:
+        """Checks an intention file, and that its standard scenario has the same number of flights."""
+        report = {'num_flights': 0, 'parse_errors': 0, 'duplicate_acids': 0, 'unordered_times': 0,
+                  'unknown_nodes': 0, 'same_origin_destination': 0, 'scenario_mismatch': 0}
+        acids = set()
+        prev_time = -1.
+        with open(filename, 'r') as f:
+            for line in f:
+                if not line.strip():
+                    continue
+                fields = line.strip().split(';')
+                report['num_flights'] += 1
+                try:
+                    acid, _, spawn_time, origin, destination, _ = fields
+                    spawn_time = hhmmss_to_seconds(spawn_time)
+                    origin, destination = int(origin), int(destination)
+                except ValueError:
+                    report['parse_errors'] += 1
+                    continue
+                report['duplicate_acids'] += acid in acids
+                acids.add(acid)
+                report['unordered_times'] += spawn_time < prev_time
+                prev_time = spawn_time
+                report['unknown_nodes'] += (origin not in self.nodes) + (destination not in self.nodes)
+                report['same_origin_destination'] += origin == destination
+        # The standard scenario has one flight per intention
+        scenario_name = self.scenario_path + 'Standard/' + os.path.basename(filename).replace('.txt', '.scn')
+        for extension in ['', '.gz', '.zst']:
+            if os.path.exists(scenario_name + extension):
+                with open_compressed(scenario_name + extension, 'rt') as f:
+                    num_scenario_flights = sum('>M22CRE ' in line for line in f)
+                report['scenario_mismatch'] = int(num_scenario_flights != report['num_flights'])
+                break
+        return report
+
+    def kwikqdr(self, lata: float, lona: float, latb: float, lonb: float)-> float:
+        """Gives quick and dirty qdr[deg]
+        from lat/lon. (note: does not work well close to poles)"""
+        dlat    = np.radians(latb - lata)
+        dlon    = np.radians(((lonb - lona)+180)%360-180)
+        cavelat = np.cos(np.radians(lata + latb) * 0.5)
+
+        qdr     = np.degrees(np.arctan2(dlon * cavelat, dlat)) % 360
+
+        return qdr
+
+
+def main():
+    validator = ScenarioValidator()
+    # Validate everything that was generated
+    validator.validate_all()
+    return
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,102 @@
+import numpy as np
+import re
+
+# Trailing zeros of the decimals, and the decimal point if only zeros are left, of
+# numbers that are each on their own line
+TRAILING_ZEROS = re.compile(r'(\.\d*?[1-9])0+$|\.0+$', re.MULTILINE)
+
+
+class WaypointSerializer:
+    def __init__(self, latlon_decimals: int = 7, hdg_decimals: int = 1, 
+                 strip_zeros: bool = True) -> None:
+        """Formats M22CRE scenario lines with a fixed number of decimals. The waypoints
+        of a route are formatted all at once with a single format operation, and the
+        values are converted to python floats first so the output does not depend on
+        how numpy prints its scalars.
+
+        Args:
+            latlon_decimals (int): Number of decimals of the latitudes and longitudes.
+            hdg_decimals (int): Number of decimals of the heading.
+            strip_zeros (bool): Whether to remove the trailing zeros of the decimals.
+        """
+        self.latlon_decimals = latlon_decimals
+        self.hdg_decimals = hdg_decimals
+        self.strip_zeros = strip_zeros
+        self.wpt_format = ',%s,%s,,,%s,%s,%s'
+        return
+
+    def format_cre(self, spawn_time: str, acid: str, lat: float, lon: float, hdg: float,
+                   alt: float, spd: float) -> str:
+        """Gives the start of an M22CRE line, up to and including the speed."""
+        lat, lon = self.format_numbers([lat, lon], self.latlon_decimals)
+        # Wrap after rounding, such that 359.97 becomes 0 and not 360
+        hdg, = self.format_numbers([round(float(hdg), self.hdg_decimals) % 360], self.hdg_decimals)
+        return f'{spawn_time}>M22CRE {acid},M600,{lat},{lon},{hdg},{int(alt)},{int(spd)}'
+
+    def format_waypoints(self, lats, lons, turns, streets, rtas = None) -> str:
+        """Formats a whole route, each waypoint as ,lat,lon,,,RTA,FLYTURN/FLYBY,street_number
+
+        Args:
+            lats (array): Latitudes of the waypoints.
+            lons (array): Longitudes of the waypoints.
+            turns (array): Whether each waypoint is a turn (FLYTURN) or not (FLYBY).
+            streets (array): Street number of each waypoint.
+            rtas (array): RTA of each waypoint, empty if None.
+
+        Returns:
+            str: The waypoints text.
+        """
+        num_wpts = len(lats)
+        values = np.empty((num_wpts, 5), dtype=object)
+        values[:,0] = self.format_numbers(lats, self.latlon_decimals)
+        values[:,1] = self.format_numbers(lons, self.latlon_decimals)
+        values[:,2] = '' if rtas is None else rtas
+        values[:,3] = np.where(np.asarray(turns, dtype=bool), 'FLYTURN', 'FLYBY')
+        values[:,4] = streets
+        return (self.wpt_format * num_wpts) % tuple(values.ravel().tolist())
+
+    def format_numbers(self, values, decimals: int) -> list:
+        """Formats an array of numbers with a single format operation, and strips their
+        trailing zeros if strip_zeros is set."""
+        values = np.asarray(values, dtype=float).tolist()
+        text = (f'%.{decimals}f\n' * len(values)) % tuple(values)
+        if self.strip_zeros:
+            text = TRAILING_ZEROS.sub(r'\1', text)
+        return text.split('\n')[:-1]
+
+
+def hhmmss_to_seconds(hhmmss: str) -> float:
+    h, m, s = hhmmss.split(':')
+    return int(h) * 3600 + int(m) * 60 + float(s)
+
+
+def parse_cre_line(line: str) -> dict:
+    """Parses an M22CRE scenario line, as made by WaypointSerializer.
+
+    Args:
+        line (str): The scenario line.
+
+    Returns:
+        dict: The spawn time [s], acid, type, lat, lon, hdg, alt and spd of the aircraft, and
+        the lats, lons, rtas, turns (bool) and streets arrays of the waypoints. None if the
+        line is not an M22CRE line.
+    """
+    timestamp, _, command = line.strip().partition('>')
+    if not command.startswith('M22CRE '):
+        return None
+    fields = command[len('M22CRE '):].split(',')
+    # Each waypoint is lat, lon, alt, spd, rta, FLYTURN/FLYBY, street number
+    waypoints = np.array(fields[7:], dtype=object).reshape(-1, 7)
+    return {'time': hhmmss_to_seconds(timestamp),
+            'acid': fields[0],
+            'type': fields[1],
+            'lat': float(fields[2]),
+            'lon': float(fields[3]),
+            'hdg': float(fields[4]),
+            'alt': float(fields[5]),
+            'spd': float(fields[6]),
+            'lats': waypoints[:,0].astype(float),
+            'lons': waypoints[:,1].astype(float),
+            'rtas': waypoints[:,4].astype(str),
+            'turns': waypoints[:,5] == 'FLYTURN',
+            'streets': waypoints[:,6].astype(str)}
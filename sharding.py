@@ -0,0 +1,81 @@
+import os
+
+from async_writer import open_compressed, COMPRESSION_SUFFIX
+
+def parse_shard(text: str) -> tuple:
+    """Parses a shard given as 'i/N', with i from 0 to N-1.
+
+    Returns:
+        tuple: (i, N)
+    """
+    index, num_shards = (int(x) for x in text.split('/'))
+    if num_shards < 1 or not 0 <= index < num_shards:
+        raise ValueError(f'Shard {text} is not valid, it should be i/N with 0 <= i < N.')
+    return index, num_shards
+
+def shard_items(items: list, shard: tuple) -> list:
+    """Gives the deterministic subset of items of a shard. Every N-th item, such that
+    the work is spread evenly. The items should be in a deterministic order, so sort
+    directory listings first.
+
+    Args:
+        items (list): All the items.
+        shard (tuple): (i, N), or None for all the items.
+    """
+    if shard is None:
+        return list(items)
+    index, num_shards = shard
+    return list(items)[index::num_shards]
+
+def in_shard(item_index: int, shard: tuple) -> bool:
+    """Whether the item with this index belongs to the shard."""
+    return shard is None or item_index % shard[1] == shard[0]
+
+def shard_part_path(path: str, shard: tuple) -> str:
+    """Path of the part of a file that a shard makes."""
+    index, num_shards = shard
+    return f'{path}.part{index}of{num_shards}'
+
+def merge_shards(path: str, num_shards: int, compression: str = None) -> None:
+    """Stitches the parts made by the shards back into the full file. Line k of the
+    full file is line k // N of part k % N, the inverse of splitting with in_shard.
+    The file is written next to the parts first and then renamed, and the parts are
+    removed.
+
+    Args:
+        path (str): Path of the full file.
+        num_shards (int): Number of shards N.
+        compression (str): Compression of the full file, None, 'gzip' or 'zstd'. Its
+        suffix is appended to the path.
+    """
+    part_paths = [shard_part_path(path, (i, num_shards)) for i in range(num_shards)]
+    missing = [x for x in part_paths if not os.path.exists(x)]
+    if missing:
+        raise FileNotFoundError(f'Cannot merge {path}, missing parts: {missing}')
+    parts = []
+    for part_path in part_paths:
+        with open(part_path, 'r') as f:
+            parts.append(f.readlines())
+    num_lines = sum(len(part) for part in parts)
+    path += COMPRESSION_SUFFIX[compression]
+    with open_compressed(path + '.tmp', 'wt', compression) as f:
+        f.write(''.join(parts[k % num_shards][k // num_shards] for k in range(num_lines)))
+    os.replace(path + '.tmp', path)
+    for part_path in part_paths:
+        os.remove(part_path)
+    return
+
+def merge_all_shards(folder: str, num_shards: int, compression: str = None) -> list:
+    """Merges all the files in a folder of which the parts of all shards are there.
+
+    Returns:
+        list: The merged files.
+    """
+    suffix = f'.part0of{num_shards}'
+    merged = []
+    for filename in sorted(os.listdir(folder)):
+        if filename.endswith(suffix):
+            path = os.path.join(folder, filename[:-len(suffix)])
+            merge_shards(path, num_shards, compression)
+            merged.append(path + COMPRESSION_SUFFIX[compression])
+    return merged
@@ -1,13 +1,27 @@
 import osmnx as ox
 import numpy as np
-import networkx as nx
-from shapely.ops import linemerge
-from shapely.geometry import Point
 from multiprocessing import Pool
 import tqdm
-import random
 import os
 import re
+import heapq
+
+from scn_format import WaypointSerializer
+from sharding import shard_items
+from async_writer import get_writer
+
+# The strategic maker of a pool worker, set once by init_worker
+worker_maker = None
+
+def init_worker(maker):
+    """Pool initializer, gives the worker its own copy of the maker once, instead of
+    sending the maker and its graph along with every task."""
+    global worker_maker
+    worker_maker = maker
+    return
+
+def convert_chunk_worker(args):
+    return worker_maker.convert_chunk(*args)
 
 class StrategicScenarioMaker:
     def __init__(self) -> None:
@@ -23,34 +37,103 @@ class StrategicScenarioMaker:
         self.strategic_1D_path = self.path + '/Strategic/1D/'
         self.G = ox.load_graphml(f'{self.path}/streets.graphml') # Load the street graph
         self.nodes, self.edges = ox.graph_to_gdfs(self.G) # Load the nodes and edges from the graph
+        # Lookup tables of the node coordinates and the street numbers of the edges, which
+        # is all the conversion needs, and what the pool workers get instead of the graph.
+        self.node_lon = self.nodes.geometry.x.to_dict()
+        self.node_lat = self.nodes.geometry.y.to_dict()
+        # Of parallel edges, the shortest one, like the router takes
+        shortest_keys = self.edges['length'].groupby(level = [0, 1]).idxmin()
+        self.edge_stroke = self.edges.loc[shortest_keys, 'stroke'].droplevel(2).to_dict()
         # Aircraft related 
         self.speed = 30
         self.layer_height = 50 #ft
         self.max_altitude = 500
-        self.num_cpu = 2
+        self.num_cpu = os.cpu_count()
+        # Files are converted in parallel in chunks of about this many bytes
+        self.chunk_size = 1 << 20
+        # Sharding over multiple invocations, (i, N) or None for everything
+        self.shard = None
+        # Number of decimals in the scenario files
+        self.latlon_decimals = 7
+        self.hdg_decimals = 1
+        self.serializer = WaypointSerializer(self.latlon_decimals, self.hdg_decimals)
+        # Compression of the scenario files, None, 'gzip' or 'zstd'
+        self.compression = None
         return
     
+    def __getstate__(self):
+        # The pool workers only need the lookup tables, not the graph
+        state = self.__dict__.copy()
+        for name in ['G', 'nodes', 'edges']:
+            state.pop(name, None)
+        return state
+    
     def create_all_scenarios_from_strategic(self):
-        strategic_files = [self.strategic_4D_path + x for x in os.listdir(self.strategic_4D_path) if ('.out' in x)]
-        #strategic_files =[self.strategic_2D_path + x for x in os.listdir(self.strategic_2D_path) if ('.out' in x)]
-        #strategic_files +=[self.strategic_1D_path + x for x in os.listdir(self.strategic_1D_path) if ('.out' in x)]
+        """Converts the strategic files of the 1D, 2D and 4D folders in one pool. Every file is
+        split in chunks of lines, such that a single large file also uses all processes."""
+        strategic_files = []
+        for strategic_path in [self.strategic_1D_path, self.strategic_2D_path, self.strategic_4D_path]:
+            if os.path.isdir(strategic_path):
+                strategic_files += [strategic_path + x for x in sorted(os.listdir(strategic_path)) if ('.out' in x)]
+        strategic_files = shard_items(strategic_files, self.shard)
+        # The chunks of all files, in order
+        tasks = [(filename, start, end) for filename in strategic_files 
+                 for start, end in self.get_chunks(filename)]
         
-        with Pool(self.num_cpu) as p:
-            _ = list(tqdm.tqdm(p.imap(self.create_one_scenario, strategic_files), total = len(strategic_files)))
+        with Pool(self.num_cpu, initializer = init_worker, initargs = (self,)) as p:
+            chunks = []
+            for i, chunk in enumerate(tqdm.tqdm(p.imap(convert_chunk_worker, tasks), total = len(tasks))):
+                filename, _, end = tasks[i]
+                chunks.append(chunk)
+                # The last chunk of a file, merge and write it
+                if end == os.path.getsize(filename):
+                    self.write_scenario(filename, chunks)
+                    chunks = []
+            # Close instead of terminate, such that the workers finish writing
+            p.close()
+            p.join()
+        get_writer().flush()
         
     def create_one_scenario(self, filename):
-        with open(filename, 'r') as f:
-            lines = f.readlines()
-            
-        scen_lines = []
-        for line in lines:
-            scen_lines.append(self.get_scenario_text_from_intention_line(line))
+        """Converts one strategic file in this process."""
+        self.write_scenario(filename, [self.convert_chunk(filename, 0, os.path.getsize(filename))])
         
-        output_name = filename.replace('Strategic', 'Base_Scenarios').replace('.out','.scn')
+    def get_chunks(self, filename: str) -> list:
+        """Splits a file in byte ranges of about chunk_size bytes that start at the start of a line."""
+        size = os.path.getsize(filename)
+        bounds = [0]
+        with open(filename, 'rb') as f:
+            while bounds[-1] + self.chunk_size < size:
+                # Continue to the end of the line
+                f.seek(bounds[-1] + self.chunk_size)
+                f.readline()
+                if f.tell() >= size:
+                    break
+                bounds.append(f.tell())
+        bounds.append(size)
+        return list(zip(bounds[:-1], bounds[1:]))
+        
+    def convert_chunk(self, filename: str, start: int, end: int) -> list:
+        """Converts the lines in a byte range of a strategic file.
 
-        with open(output_name, 'w') as f:
-            sorted_lines = self.natural_sort(scen_lines)
-            f.write(''.join(sorted_lines))
+        Returns:
+            list: (sort key, scenario line) of each line, sorted.
+        """
+        with open(filename, 'rb') as f:
+            f.seek(start)
+            lines = f.read(end - start).decode().splitlines()
+        scen_lines = [self.get_scenario_text_from_intention_line(line) for line in lines if line.strip()]
+        # Sort on the time and the ACID, like natural_sort sorts the whole lines
+        return sorted((self.natural_key(line.split(',', 1)[0]), line) for line in scen_lines)
+    
+    def write_scenario(self, filename: str, chunks: list) -> None:
+        """Merges the sorted chunks of a strategic file and writes the scenario file."""
+        output_name = filename.replace('Strategic', 'Base_Scenarios').replace('.out','.scn')
+        os.makedirs(os.path.dirname(output_name), exist_ok=True)
+        # Hand the file to the background writer, which renames it when it is complete
+        with get_writer().open(output_name, self.compression) as f:
+            for _, line in heapq.merge(*chunks):
+                f.write(line)
                 
     def kwikdist(self, lata: float, lona: float, latb:float, lonb:float) -> float:
         """Gives quick and dirty dist [m]
@@ -92,73 +175,50 @@ class StrategicScenarioMaker:
         alt = int(line_split[1]) * self.layer_height
         dep_time = line_split[2]
         origin_node = int(line_split[3])
-        origin_lon, origin_lat = self.nodes.at[origin_node,'geometry'].x, self.nodes.at[origin_node,'geometry'].y
+        origin_lon, origin_lat = self.node_lon[origin_node], self.node_lat[origin_node]
         # We also want the next waypoint coords
         nxt_node = int(line_split[5])
-        nxtwp_lon, nxtwp_lat = self.nodes.at[nxt_node,'geometry'].x, self.nodes.at[nxt_node,'geometry'].y
-        street_number = self.edges.at[(origin_node, nxt_node, 0), 'stroke']
+        nxtwp_lon, nxtwp_lat = self.node_lon[nxt_node], self.node_lat[nxt_node]
+        street_number = self.edge_stroke[(origin_node, nxt_node)]
         hdg = self.kwikqdr(origin_lat, origin_lon, nxtwp_lat, nxtwp_lon)
         # We can now initialise the CRE text
-        scen_text = f'{dep_time}>M22CRE {acid},M600,{origin_lat},{origin_lon},{hdg},{alt},{self.speed}'
+        scen_text = self.serializer.format_cre(dep_time, acid, origin_lat, origin_lon, hdg, alt, self.speed)
         # The RTA of the first waypoint, which is also the origin, doesn't matter.
         # Now, let's separate the route from the beginning
         route = line_split[3:]
         # Let's reshape this guy to a thing multiple of 2
         route_arr = np.reshape(route, (int(len(route)/2), 2))
-        # now add the waypoints
-        for i, wpdata in enumerate(route_arr):
-            # Get the data from the waypoint_arr
-            current_node = int(wpdata[0])
-            lon, lat = self.nodes.at[current_node,'geometry'].x, self.nodes.at[current_node,'geometry'].y
-            
-            rta = wpdata[1]
-            if rta == '00:00:00':
-                rta = ''
-                
-            if i == 0:
-                # origin, not a turn
-                scen_text += f',{lat},{lon},,,{rta},FLYBY,{street_number}'
-                continue
-                
-            # Now get the street number
-            v = current_node
-            u = int(route_arr[:,0][i-1])
-            street_number = self.edges.at[(u, v, 0), 'stroke']
-            
-            # Now append the waypoint information to the scen_text
-            # First and last waypoint always a turn
-            if i == len(route_arr)-1:
-                # Last waypoint, add a \n
-                scen_text += f',{lat},{lon},,,{rta},FLYTURN,{street_number}\n'
-            else:
-                # We need to find the angle to determine whether it is a turn or not
-                # Get the needed stuff
-                prev_node = int(route_arr[:,0][i-1])
-                next_node = int(route_arr[:,0][i+1])
-                lon_prev, lat_prev = self.nodes.at[prev_node,'geometry'].x, self.nodes.at[prev_node,'geometry'].y
-                lon_next, lat_next = self.nodes.at[next_node,'geometry'].x, self.nodes.at[next_node,'geometry'].y
-                
-                # Get the angle
-                d1=self.kwikqdr(lat_prev,lon_prev,lat,lon)
-                d2=self.kwikqdr(lat,lon,lat_next,lon_next)
-                angle=abs(d2-d1)
-
-                if angle>180:
-                    angle=360-angle
-                    
-                # This is a turn if angle is greater than 25
-                if angle > 25:
-                    scen_text += f',{lat},{lon},,,{rta},FLYTURN,{street_number}'
-                else:
-                    scen_text += f',{lat},{lon},,,{rta},FLYBY,{street_number}'
-
+        route_nodes = [int(node) for node in route_arr[:,0]]
+        # Get the data of all the waypoints
+        lons = np.array([self.node_lon[node] for node in route_nodes])
+        lats = np.array([self.node_lat[node] for node in route_nodes])
+        rtas = np.where(route_arr[:,1] == '00:00:00', '', route_arr[:,1])
+        # The origin has the street number of the first edge, the others the one of the
+        # edge that leads to them.
+        street_numbers = [street_number] + [self.edge_stroke[(u, v)] 
+                                            for u, v in zip(route_nodes[:-1], route_nodes[1:])]
+        # We need to find the angles to determine whether waypoints are turns or not
+        d1 = self.kwikqdr(lats[:-2], lons[:-2], lats[1:-1], lons[1:-1])
+        d2 = self.kwikqdr(lats[1:-1], lons[1:-1], lats[2:], lons[2:])
+        angle = np.abs(d2 - d1)
+        angle = np.where(angle > 180, 360 - angle, angle)
+        # This is a turn if angle is greater than 25. The origin is not a turn, and
+        # the last waypoint always is.
+        turns = np.ones(len(route_nodes), dtype=bool)
+        turns[1:-1] = angle > 25
+        turns[0] = False
+        # Now append the waypoint information to the scen_text
+        scen_text += self.serializer.format_waypoints(lats, lons, turns, street_numbers, rtas) + '\n'
         return scen_text
     
     @staticmethod
-    def natural_sort(l): 
+    def natural_key(text):
         convert = lambda text: int(text) if text.isdigit() else text.lower()
-        alphanum_key = lambda key: [convert(c) for c in re.split('([0-9]+)', key)]
-        return sorted(l, key=alphanum_key)
+        return [convert(c) for c in re.split('([0-9]+)', text)]
+    
+    @staticmethod
+    def natural_sort(l): 
+        return sorted(l, key=StrategicScenarioMaker.natural_key)
     
 
 def main():
@@ -0,0 +1,201 @@
+import osmnx as ox
+import numpy as np
+from multiprocessing import Pool
+import random
+import time
+import tqdm
+import os
+
+from routing import make_router
+from sharding import shard_items
+
+# The strategic planner of a pool worker, set once by init_worker
+worker_planner = None
+
+def init_worker(planner):
+    """Pool initializer, gives the worker its own copy of the planner once, instead of
+    sending the planner and its graph along with every task."""
+    global worker_planner
+    worker_planner = planner
+    return
+
+def plan_one_intention_worker(filename):
+    return worker_planner.plan_one_intention(filename)
+
+class StrategicPlanner:
+    def __init__(self, routing_backend: str = 'scipy') -> None:
+        """Greedy strategic deconfliction of flight intentions. Flights are planned in
+        departure order, and each one gets the first altitude layer and departure delay
+        for which its route is free in a reservation table indexed by (edge or node,
+        layer, time bin). A reservation also blocks the time bins next to it, such that
+        flights just on either side of a bin boundary conflict too. Edges are reserved in
+        both directions, as the layers are not one way, so opposite traffic on the same
+        street segment also conflicts. Flights for which no free slot is found fly their
+        first layer without delay, and still reserve it, such that the flights after them
+        are planned around them. The output has the same format as the .out files of the
+        external strategic solvers, so StrategicScenarioMaker can convert it.
+
+        Args:
+            routing_backend (str): 'networkx', 'scipy', 'alt' or 'bialt'.
+        """
+        # City related parameters
+        self.city = 'Vienna' # City name
+        self.path = f'{self.city}' # Folder path
+        self.intention_path = self.path + '/Intentions/'
+        self.strategic_path = self.path + '/Strategic/'
+        self.G = ox.load_graphml(f'{self.path}/streets.graphml') # Load the street graph
+        self.routing_backend = routing_backend
+        self.router = make_router(self.G, self.routing_backend, 
+                                  landmark_path = f'{self.path}/landmarks.npz')
+        # Aircraft related
+        self.speed = 30 # kts
+        self.layer_height = 50 #ft
+        self.max_altitude = 500
+        # Planning parameters
+        self.dof = '4D' # '1D': layers only, '2D': also delays, '4D': also RTAs at every node
+        self.time_bin = 5 # seconds, size of a reservation slot
+        self.delay_step = 5 # seconds
+        self.max_delay = 300 # seconds
+        self.seed = 0
+        self.num_cpu = 2
+        # Sharding over multiple invocations, (i, N) or None for everything
+        self.shard = None
+        # Edge lengths of the cheapest edge between each two nodes, like the router uses
+        self.edge_length = dict()
+        for u, v, data in self.G.edges(data=True):
+            if (u, v) not in self.edge_length or data['length'] < self.edge_length[(u, v)]:
+                self.edge_length[(u, v)] = float(data['length'])
+        return
+
+    def plan_all_intentions(self) -> dict:
+        """Plans all the intention files, one file per process.
+
+        Returns:
+            dict: The number of flights without a conflict free slot, by file.
+        """
+        os.makedirs(self.strategic_path + self.dof, exist_ok=True)
+        intention_files = [x for x in sorted(os.listdir(self.intention_path)) if x.endswith('.txt')]
+        intention_files = shard_items(intention_files, self.shard)
+        with Pool(self.num_cpu, initializer = init_worker, initargs = (self,)) as p:
+            num_unresolved = list(tqdm.tqdm(p.imap(plan_one_intention_worker, intention_files),
+                                            total = len(intention_files)))
+        num_unresolved = dict(zip(intention_files, num_unresolved))
+        for filename, num in num_unresolved.items():
+            if num > 0:
+                print(f'{filename}: {num} flights could not be deconflicted.')
+        return num_unresolved
+
+    def plan_one_intention(self, filename: str) -> int:
+        """Plans one intention file and writes the .out file.
+
+        Args:
+            filename (str): Name of the intention file in the intention folder.
+
+        Returns:
+            int: Number of flights for which no conflict free slot was found.
+        """
+        with open(self.intention_path + filename, 'r') as f:
+            intention_lines = [line.replace('\n','').split(';') for line in f if line.strip()]
+        out_lines, num_unresolved = self.plan(intention_lines)
+        with open(self.strategic_path + self.dof + '/' + filename.replace('.txt', '.out'), 'w') as f:
+            f.write(''.join(out_lines))
+        return num_unresolved
+
+    def plan(self, intention_lines: list) -> tuple:
+        """Plans a list of flight intentions.
+
+        Args:
+            intention_lines (list): Split intention lines, in the order
+            acid, ac_model, spawn_time_hhmmss, spawn_node, destination_node, priority
+
+        Returns:
+            tuple: The strategic lines and the number of flights that could not be deconflicted.
+        """
+        rng = random.Random(self.seed)
+        num_layers = len(np.arange(self.layer_height, self.max_altitude, self.layer_height))
+        speed = self.speed * 0.514444 # m/s
+        # Reservation table, (kind, element, layer, time bin) -> acid
+        reservations = dict()
+        # Only delay in the DOFs that allow it
+        if self.dof == '1D':
+            delays = [0]
+        else:
+            delays = range(0, self.max_delay + 1, self.delay_step)
+        # Plan in departure order
+        flights = sorted(intention_lines, key = lambda x: (self.hhmmss_to_seconds(x[2]), int(x[0][1:])))
+        out_lines = []
+        num_unresolved = 0
+        for intention in flights:
+            acid, dep_time = intention[0], self.hhmmss_to_seconds(intention[2])
+            route = self.router.shortest_path(int(intention[3]), int(intention[4]))
+            # Time at which each node is reached, relative to departure
+            lengths = [self.edge_length[(u, v)] for u, v in zip(route[:-1], route[1:])]
+            node_times = np.concatenate([[0.], np.cumsum(lengths) / speed])
+            # Start from a random layer to spread the traffic over all of them
+            first_layer = rng.randrange(num_layers)
+            layers = [(first_layer + i) % num_layers + 1 for i in range(num_layers)]
+            slot = None
+            for delay in delays:
+                keys = self.get_reservation_keys(route, dep_time + delay + node_times)
+                for layer in layers:
+                    # A slot is free if none of its elements is reserved in this layer,
+                    # in the same or a neighbouring time bin
+                    if not any((kind, element, layer, time_bin + i) in reservations
+                               for kind, element, time_bin in keys for i in (-1, 0, 1)):
+                        slot = (delay, layer, keys)
+                        break
+                if slot is not None:
+                    break
+            if slot is None:
+                # No free slot, fly the first layer without delay anyway. It is still
+                # reserved, as the flight is there and the next flights must avoid it.
+                num_unresolved += 1
+                slot = (0, layers[0], self.get_reservation_keys(route, dep_time + node_times))
+            delay, layer, keys = slot
+            for kind, element, time_bin in keys:
+                reservations[(kind, element, layer, time_bin)] = acid
+            out_lines.append(self.get_strategic_line(acid, layer, dep_time + delay, route,
+                                                     dep_time + delay + node_times))
+        return out_lines, num_unresolved
+
+    def get_reservation_keys(self, route: list, node_times: np.ndarray) -> list:
+        """Gives the (kind, element, time bin) entries that a flight occupies. Edges are
+        occupied in every time bin between entering and leaving them, nodes in the time
+        bin in which they are passed. Edges are undirected, as frozenset((u, v))."""
+        node_bins = (node_times // self.time_bin).astype(int)
+        keys = [('node', node, time_bin) for node, time_bin in zip(route, node_bins)]
+        for i, (u, v) in enumerate(zip(route[:-1], route[1:])):
+            keys += [('edge', frozenset((u, v)), time_bin) for time_bin in range(node_bins[i], node_bins[i+1] + 1)]
+        return keys
+
+    def get_strategic_line(self, acid: str, layer: int, dep_time: float, route: list,
+                           node_times: np.ndarray) -> str:
+        """Gives the line in the format that get_scenario_text_from_intention_line parses:
+        ACID, ALT layer, DEP-TIME [HH:MM:SS], then NODE, RTA [HH:MM:SS] for each waypoint."""
+        if self.dof == '4D':
+            rtas = [self.seconds_to_hhmmss(t) for t in node_times]
+            # The RTA of the origin is the departure
+            rtas[0] = '00:00:00'
+        else:
+            rtas = ['00:00:00'] * len(route)
+        waypoints = ','.join(f'{node},{rta}' for node, rta in zip(route, rtas))
+        return f'{acid},{layer},{self.seconds_to_hhmmss(dep_time)},{waypoints}\n'
+
+    @staticmethod
+    def hhmmss_to_seconds(hhmmss: str) -> float:
+        h, m, s = hhmmss.split(':')
+        return int(h) * 3600 + int(m) * 60 + float(s)
+
+    @staticmethod
+    def seconds_to_hhmmss(seconds: float) -> str:
+        return time.strftime('%H:%M:%S', time.gmtime(round(seconds)))
+
+
+def main():
+    planner = StrategicPlanner()
+    # Plan all the intentions
+    planner.plan_all_intentions()
+    return
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,175 @@
+import numpy as np
+from scipy.spatial import cKDTree
+from multiprocessing import Pool
+import tqdm
+import os
+
+from scn_format import parse_cre_line
+from async_writer import open_compressed
+
+class TrafficAnalyser:
+    def __init__(self) -> None:
+        """Estimates the traffic density and the losses of separation of a scenario without
+        running BlueSky. Every flight flies its route at its CRE speed from its spawn time,
+        at its CRE altitude, and all positions are sampled at once."""
+        # City related parameters
+        self.city = 'Vienna' # City name
+        self.path = f'{self.city}' # Folder path
+        self.scenario_path = self.path + '/Base_Scenarios/'
+        # Analysis parameters
+        self.time_step = 1 # seconds between position samples
+        self.cell_size = 200 # metres, horizontal size of a density cell
+        self.density_time_bin = 60 # seconds, time size of a density cell
+        self.separation = 32 # metres, horizontal separation minimum
+        self.layer_height = 50 #ft
+        self.num_hotspots = 10
+        self.num_cpu = 4
+        return
+
+    def analyse_all(self, folder: str) -> dict:
+        """Analyses all the scenarios in a folder, one file per process.
+
+        Args:
+            folder (str): Folder in the base scenario folder, like 'Standard' or '4D'.
+
+        Returns:
+            dict: The report of each file, by file name.
+        """
+        filenames = sorted(x for x in os.listdir(self.scenario_path + folder)
+                           if x.endswith(('.scn', '.scn.gz', '.scn.zst')))
+        paths = [self.scenario_path + folder + '/' + x for x in filenames]
+        with Pool(self.num_cpu) as p:
+            reports = list(tqdm.tqdm(p.imap(self.analyse_file, paths), total = len(paths)))
+        for filename, report in zip(filenames, reports):
+            print(f'{filename}: {report["num_flights"]} flights, '
+                  f'max {report["max_airborne"]} airborne, '
+                  f'{report["los_pairs"]} LoS pairs, {report["los_pair_seconds"]} LoS pair-seconds')
+        return dict(zip(filenames, reports))
+
+    def analyse_file(self, filename: str) -> dict:
+        """Analyses one scenario file, which can be compressed."""
+        with open_compressed(filename, 'rt') as f:
+            flights = [flight for flight in map(parse_cre_line, f) if flight is not None]
+        return self.analyse(flights)
+
+    def analyse(self, flights: list) -> dict:
+        """Analyses a list of parsed M22CRE lines.
+
+        Args:
+            flights (list): Flights as given by parse_cre_line.
+
+        Returns:
+            dict: num_flights, max_airborne, los_pairs (number of flight pairs that lose
+            separation at least once), los_pair_seconds (time steps of pairs in LoS) and
+            hotspots (list of (lat, lon, layer, time, count) of the busiest density cells).
+        """
+        if not flights:
+            return {'num_flights': 0, 'max_airborne': 0, 'los_pairs': 0,
+                    'los_pair_seconds': 0, 'hotspots': []}
+        flight_idx, t, lat, lon, layer = self.sample_positions(flights)
+        # Local flat coordinates in metres around the mean position
+        lat0, lon0 = np.mean(lat), np.mean(lon)
+        y = np.radians(lat - lat0) * 6371000.
+        x = np.radians(lon - lon0) * 6371000. * np.cos(np.radians(lat0))
+        max_airborne = int(np.max(np.bincount(np.round(t / self.time_step).astype(np.int64))))
+        los_pairs, los_pair_seconds = self.get_los(flight_idx, t, x, y, layer)
+        hotspots = self.get_hotspots(t, x, y, layer, lat0, lon0)
+        return {'num_flights': len(flights), 'max_airborne': max_airborne, 'los_pairs': los_pairs,
+                'los_pair_seconds': los_pair_seconds, 'hotspots': hotspots}
+
+    def sample_positions(self, flights: list) -> tuple:
+        """Samples the position of all flights every time step, for all flights at once.
+
+        Returns:
+            tuple: flight index, time, lat, lon and altitude layer of every sample.
+        """
+        num_wpts = np.array([len(flight['lats']) for flight in flights])
+        wpt_flight = np.repeat(np.arange(len(flights)), num_wpts)
+        lats = np.concatenate([flight['lats'] for flight in flights])
+        lons = np.concatenate([flight['lons'] for flight in flights])
+        spawn_times = np.array([flight['time'] for flight in flights])
+        speeds = np.array([flight['spd'] for flight in flights]) * 0.514444 # kts to m/s
+        layers = np.array([flight['alt'] for flight in flights]) // self.layer_height
+        # Length of each leg, zero for the first waypoint of each flight
+        leg_length = self.kwikdist(lats[:-1], lons[:-1], lats[1:], lons[1:])
+        leg_length = np.concatenate([[0.], leg_length])
+        first_wpt = np.cumsum(num_wpts) - num_wpts
+        leg_length[first_wpt] = 0.
+        # Time at which every waypoint is reached
+        cum_length = np.cumsum(leg_length)
+        cum_length -= np.repeat(cum_length[first_wpt], num_wpts)
+        wpt_time = spawn_times[wpt_flight] + cum_length / speeds[wpt_flight]
+        # Sample times of each flight, from spawn until the last waypoint
+        last_wpt = first_wpt + num_wpts - 1
+        num_samples = np.floor((wpt_time[last_wpt] - spawn_times) / self.time_step).astype(int) + 1
+        sample_flight = np.repeat(np.arange(len(flights)), num_samples)
+        sample_step = np.arange(num_samples.sum()) - np.repeat(np.cumsum(num_samples) - num_samples, num_samples)
+        sample_time = spawn_times[sample_flight] + sample_step * self.time_step
+        # Find the leg of every sample in one search, by offsetting the flights in time
+        offset = (np.max(wpt_time) + 1) * np.arange(len(flights))
+        leg_end = np.searchsorted(wpt_time + offset[wpt_flight], sample_time + offset[sample_flight], side='right')
+        leg_end = np.clip(leg_end, first_wpt[sample_flight] + 1, last_wpt[sample_flight])
+        leg_start = leg_end - 1
+        # Interpolate along the legs
+        duration = wpt_time[leg_end] - wpt_time[leg_start]
+        frac = np.where(duration > 0, (sample_time - wpt_time[leg_start]) / np.where(duration > 0, duration, 1), 0.)
+        frac = np.clip(frac, 0., 1.)
+        sample_lat = lats[leg_start] + frac * (lats[leg_end] - lats[leg_start])
+        sample_lon = lons[leg_start] + frac * (lons[leg_end] - lons[leg_start])
+        return sample_flight, sample_time, sample_lat, sample_lon, layers[sample_flight]
+
+    def get_los(self, flight_idx: np.ndarray, t: np.ndarray, x: np.ndarray, y: np.ndarray,
+                layer: np.ndarray) -> tuple:
+        """Finds all the samples that are within the separation of each other, in the same
+        layer and at the same time. Time and layer are added as extra dimensions that are
+        so far apart that only samples with the same value can be neighbours."""
+        far = 10 * self.separation
+        points = np.column_stack([x, y, np.round(t / self.time_step) * far, layer * far])
+        pairs = cKDTree(points).query_pairs(self.separation, output_type = 'ndarray')
+        if len(pairs) == 0:
+            return 0, 0
+        flight_pairs = np.sort(flight_idx[pairs], axis = 1)
+        # Samples of the same flight are never at the same time, but be safe
+        flight_pairs = flight_pairs[flight_pairs[:,0] != flight_pairs[:,1]]
+        return len(np.unique(flight_pairs, axis = 0)), len(flight_pairs)
+
+    def get_hotspots(self, t: np.ndarray, x: np.ndarray, y: np.ndarray, layer: np.ndarray,
+                     lat0: float, lon0: float) -> list:
+        """Bins the samples in space x altitude x time cells and gives the busiest ones."""
+        cells = np.column_stack([np.floor(x / self.cell_size), np.floor(y / self.cell_size), layer,
+                                 np.floor(t / self.density_time_bin)]).astype(np.int64)
+        unique_cells, counts = np.unique(cells, axis = 0, return_counts = True)
+        # A sample is one aircraft during one time step, so this is the average number of
+        # aircraft in the cell during the time bin.
+        density = counts * self.time_step / self.density_time_bin
+        hotspots = []
+        for i in np.argsort(-density)[:self.num_hotspots]:
+            ix, iy, cell_layer, it = unique_cells[i]
+            lat = lat0 + np.degrees((iy + 0.5) * self.cell_size / 6371000.)
+            lon = lon0 + np.degrees((ix + 0.5) * self.cell_size / (6371000. * np.cos(np.radians(lat0))))
+            hotspots.append((float(lat), float(lon), int(cell_layer), int(it * self.density_time_bin),
+                             float(density[i])))
+        return hotspots
+
+    def kwikdist(self, lata: float, lona: float, latb:float, lonb:float) -> float:
+        """Gives quick and dirty dist [m]
+        from lat/lon. (note: does not work well close to poles)"""
+
+        re      = 6371000.  # radius earth [m]
+        dlat    = np.radians(latb - lata)
+        dlon    = np.radians(((lonb - lona)+180)%360-180)
+        cavelat = np.cos(np.radians(lata + latb) * 0.5)
+
+        dangle  = np.sqrt(dlat * dlat + dlon * dlon * cavelat * cavelat)
+        dist    = re * dangle
+        return dist
+
+
+def main():
+    analyser = TrafficAnalyser()
+    # Analyse the standard scenarios
+    analyser.analyse_all('Standard')
+    return
+
+if __name__ == "__main__":
+    main()